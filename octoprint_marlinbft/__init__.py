@@ -6,7 +6,6 @@ Marlin Binary File Transfer Module
 from __future__ import absolute_import, unicode_literals
 
 import os
-import threading
 import time
 
 import flask
@@ -14,10 +13,19 @@ import octoprint.plugin
 from binproto2 import FatalError, FileTransferProtocol, Protocol
 from octoprint.events import Events
 
-from octoprint_marlinbft.utils import BftLogger, DialogHandler, BftHandler, ApiHandler
-from octoprint_marlinbft.utils import DeleteUpload, Setting, Phase, BftEvents
+from octoprint_marlinbft.utils import BftLogger, DialogHandler, BftHandler, ApiHandler, MessageChannel, MessageLog
+from octoprint_marlinbft.utils import Compression, DeleteUpload, Setting, Phase, BftEvents
 
-from octoprint_marlinbft.transfer import Process
+from octoprint_marlinbft.broadcast import Broadcast, SharedPayload
+from octoprint_marlinbft.cache import PayloadCache
+from octoprint_marlinbft.history import TransferHistory
+from octoprint_marlinbft.jobs import JobHandler, JobRegistry, TransferJob
+from octoprint_marlinbft.metrics import Metrics
+from octoprint_marlinbft.reconnect import Reconnector
+from octoprint_marlinbft.scheduler import PortBusyError, TransferScheduler
+from octoprint_marlinbft.stream import StreamSource, StreamTransferHandler
+from octoprint_marlinbft.sync import SyncManifest
+from octoprint_marlinbft.transfer import Process, ResumeStore
 
 CAP_BINARY_FILE_TRANSFER = "BINARY_FILE_TRANSFER"
 
@@ -29,18 +37,41 @@ class MarlinbftPlugin(octoprint.plugin.StartupPlugin,
                       octoprint.plugin.AssetPlugin,
                       octoprint.plugin.TemplatePlugin,
                       octoprint.plugin.EventHandlerPlugin,
-                      octoprint.plugin.SimpleApiPlugin):
+                      octoprint.plugin.SimpleApiPlugin,
+                      octoprint.plugin.BlueprintPlugin):
 
-    transfer_process = None
-        
     def __init__(self):
         self.bft_logger = None
+        self.payload_cache = None
+        self.scheduler = None
+        self.resume_store = ResumeStore()
+        self.sync_manifest = None
+        self.job_registry = None
+        self.broadcasts = None
+        self.reconnector = None
+        self.history = None
+        self.profile_folder = None
+        self.message_log = None
+        self.metrics = Metrics()
    
     ##~~ StartupPlugin
 
     def on_after_startup(self):
         self._logger.info("MARLIN BFT MARK II")
-        self.bft_logger = BftLogger(self._logger, self._plugin_manager)
+        self.message_log = MessageLog(os.path.join(self.get_plugin_data_folder(), "messages.log"), self._logger)
+        self.bft_logger = BftLogger(self._logger, self._plugin_manager,
+                                    channel=MessageChannel(self._plugin_manager, self._settings.get_int(Setting.MessageWindow),
+                                                           log=self.message_log),
+                                    metrics=self.metrics)
+        self.payload_cache = PayloadCache(os.path.join(self.get_plugin_data_folder(), "cache"), self._logger)
+        self.scheduler = TransferScheduler(self._logger, lambda: self._settings.get_int(Setting.MaxWorkers))
+        self.reconnector = Reconnector(self._printer, self.scheduler, self._logger)
+        self.job_registry = JobRegistry(self._settings.get_int(Setting.JobHistorySize))
+        self.broadcasts = JobRegistry(self._settings.get_int(Setting.JobHistorySize))
+        self.history = TransferHistory(os.path.join(self.get_plugin_data_folder(), "history.db"), self._logger,
+                                       self._settings.get_int(Setting.HistoryRetentionDays))
+        self.sync_manifest = SyncManifest(os.path.join(self.get_plugin_data_folder(), "sync_manifest.json"), self._logger)
+        self.profile_folder = os.path.join(self.get_plugin_data_folder(), "profiles")
         self._settings.set(Setting.HasCapability, False)
 
     ##~~ SettingsPlugin
@@ -48,12 +79,42 @@ class MarlinbftPlugin(octoprint.plugin.StartupPlugin,
     def get_settings_defaults(self):
         return dict(
             accept_extensions          = "bin,cur",
+            block_size                 = 512,
+            block_size_adaptive        = False,
+            block_size_memory          = dict(),
+            block_size_min             = 64,
+            cache_enable               = True,
+            cache_size_mb              = 16,
             comm_timeout_ms            = 1000,
+            comm_timeout_adaptive      = False,
+            comm_timeout_max_ms        = 5000,
+            comm_timeout_min_ms        = 100,
+            compression                = Compression.Auto,
             has_capability             = False,
             delete_upload              = DeleteUpload.Never,
+            escalate_baudrate          = 0,
+            escalate_baudrate_gcode    = "M575 B{baudrate}",
+            history_retention_days     = 365,
+            job_history_size           = 50,
+            max_workers                = 4,
+            message_window_ms          = 250,
             phase                      = Phase.Inactive,
+            pipeline_window            = 0,
             post_transfer_gcode        = ["M997"],
             post_transfer_gcode_enable = False,
+            profile_transfers          = False,
+            progress_interval_ms       = 500,
+            queue_busy_port            = False,
+            stream_buffer_kb           = 256,
+            stream_cache               = True,
+            stream_upload              = False,
+            read_buffer_kb             = 64,
+            readiness_probe            = True,
+            readiness_probe_gcode      = "M105",
+            readiness_interval_ms      = 250,
+            sync_query_remote          = True,
+            terminal_max_lines         = 1000,
+            transfer_retries           = 0,
             reconnect                  = True,
             upload_folder              = "marlinbft",
             wait_after_connect_ms      = 0,
@@ -94,21 +155,61 @@ class MarlinbftPlugin(octoprint.plugin.StartupPlugin,
     def get_api_commands(self):
         return dict(
             start_transfer=["local_path", "port", "baudrate"],
+            start_batch_transfer=["local_paths", "port", "baudrate"],
+            sync_folder=["port", "baudrate"],
+            start_broadcast=["local_path", "targets"],
             change_phase=["curr"]
         )
 
     def on_api_command(self, command, data):
-        handlers = dict(
-            dialog=lambda : DialogHandler(self._logger, self._event_bus, self._settings),
-            api=lambda : ApiHandler()
-        )
+        def _submit(start, local_paths):
+            handler = self._create_handler(data["handler_type"])
+            job = TransferJob(command, data["port"], data["baudrate"], local_paths)
+            # registered first, so the job can be looked up as soon as it starts
+            self.job_registry.add(job)
+            try:
+                started = start(handler=JobHandler(job, handler), **data)
+            except PortBusyError as exc:
+                self.job_registry.remove(job)
+                return None, flask.make_response(str(exc), 409)
+            return job, started
 
         def _start_transfer():
             self._logger.info("API: start_transfer")
             self._logger.info(data)
-            handler = handlers.get(data["handler_type"], lambda: BftHandler())()
-            remote_name = self._start_binary_transfer(handler=handler, **data)
-            return flask.make_response(remote_name, 200)
+            job, remote_name = _submit(self._start_binary_transfer, [data["local_path"]])
+            if not job:
+                return remote_name
+            job.remote_names = [remote_name]
+            return flask.jsonify(job_id=job.id, remote_name=remote_name)
+
+        def _start_batch_transfer():
+            self._logger.info("API: start_batch_transfer")
+            self._logger.info(data)
+            job, remote_names = _submit(self._start_batch_binary_transfer, data["local_paths"])
+            if not job:
+                return remote_names
+            job.remote_names = remote_names
+            return flask.jsonify(job_id=job.id, remote_names=remote_names)
+
+        def _sync_folder():
+            self._logger.info("API: sync_folder")
+            self._logger.info(data)
+            job, local_paths = _submit(self._start_sync_folder, [])
+            if not job:
+                return local_paths
+            job.local_paths = local_paths
+            return flask.jsonify(job_id=job.id, local_paths=local_paths)
+
+        def _start_broadcast():
+            self._logger.info("API: start_broadcast")
+            self._logger.info(data)
+            if not data["targets"] or not all(target.get("port") and target.get("baudrate") for target in data["targets"]):
+                return flask.make_response("Every target needs a port and a baudrate", 400)
+            broadcast = self._start_broadcast(**data)
+            return flask.jsonify(broadcast_id=broadcast.id, remote_name=broadcast.remote_name,
+                                 targets=[dict(port=target["port"], job_id=target["job_id"], error=target["error"])
+                                          for target in broadcast.to_dict()["targets"]])
 
         def _change_phase():
             self._logger.info("API: change_phase")
@@ -120,39 +221,243 @@ class MarlinbftPlugin(octoprint.plugin.StartupPlugin,
 
         return dict(
             start_transfer=_start_transfer,
+            start_batch_transfer=_start_batch_transfer,
+            sync_folder=_sync_folder,
+            start_broadcast=_start_broadcast,
             change_phase=_change_phase
         ).get(command, raise_error)()
-        
+
+    def _create_handler(self, handler_type):
+        return dict(
+            dialog=lambda : DialogHandler(self._logger, self._event_bus, self._settings),
+            api=lambda : ApiHandler()
+        ).get(handler_type, lambda: BftHandler())()
+
+    def on_api_get(self, request):
+        if request.args.get("stats"):
+            return flask.jsonify(printers=self.history.stats(request.args.get("days", 30, type=int)))
+
+        if request.args.get("history"):
+            return flask.jsonify(transfers=self.history.recent(request.args.get("history", 50, type=int),
+                                                               request.args.get("printer")))
+
+        broadcast_id = request.args.get("broadcast")
+        if broadcast_id:
+            broadcast = self.broadcasts.get(broadcast_id)
+            if not broadcast:
+                return flask.make_response("Unknown broadcast %s" % broadcast_id, 404)
+            return flask.jsonify(broadcast.to_dict())
+
+        job_id = request.args.get("job")
+        if job_id:
+            job = self.job_registry.get(job_id)
+            if not job:
+                return flask.make_response("Unknown job %s" % job_id, 404)
+            return flask.jsonify(job.to_dict())
+
+        return flask.jsonify(jobs=[job.to_dict(output=False) for job in self.job_registry.list()])
+
     def _start_binary_transfer(self, handler, port, baudrate, local_path, **data):
         self._logger.info(data)
-        handler.fire_changed(Phase.PreConnect, local_path)
+        queue = self._check_port(port, data)
 
-        _, local_basename = os.path.split(local_path)
-        root, ext = os.path.splitext(local_basename)
-        remote_basename = os.path.basename(root)[:8] + ext[:4]
+        handler.fire_changed(Phase.PreConnect, local_path)
 
-        disk_path = self._file_manager.path_on_disk("local", local_path)
-        self._logger.info("Path on disk '%s'" % disk_path)
+        local_basename, remote_basename, disk_path = self._resolve_paths(local_path)
         self.bft_logger.info("Starting transfer of %s to %s on remote" % (local_path, remote_basename))
 
-        if not MarlinbftPlugin.transfer_process:
-            MarlinbftPlugin.transfer_process = Process(self._logger, self._settings, self.bft_logger)
-        
-        thread = threading.Thread(target=MarlinbftPlugin.transfer_process.start, args=(
+        process = Process(self._logger, self._settings, self.bft_logger, self.payload_cache, self.resume_store,
+                          self.reconnector, self.history, self.metrics, self.profile_folder)
+        self.scheduler.submit(port, lambda: process.start(
             handler,
             local_basename,
             remote_basename,
             disk_path,
             port,
             baudrate,
-            local_path
-        ), kwargs=data)
-
-        thread.daemon = True
-        thread.start()
+            local_path,
+            **data
+        ), queue=queue)
 
         return remote_basename
 
+    def _start_stream_transfer(self, args, total):
+        data = self._stream_overrides(args)
+        handler = self._create_handler(data.pop("handler_type", "api"))
+        port = data.pop("port")
+        baudrate = data.pop("baudrate")
+        filename = data.pop("filename")
+
+        job = TransferJob("stream", port, baudrate, [filename])
+        handler = JobHandler(job, handler)
+        queue = self._check_port(port, data)
+
+        handler.fire_changed(Phase.PreConnect)
+
+        local_basename, remote_basename = self._remote_name(filename)
+        self.bft_logger.info("Starting streamed transfer of %s to %s on remote" % (filename, remote_basename))
+
+        source = StreamSource(self._settings.get_int(Setting.StreamBuffer) * 1024)
+        process = Process(self._logger, self._settings, self.bft_logger, self.payload_cache, self.resume_store,
+                          self.reconnector, self.history, self.metrics, self.profile_folder)
+        job.remote_names = [remote_basename]
+        self.job_registry.add(job)
+        try:
+            self.scheduler.submit(port, lambda: process.start_stream(
+                handler,
+                source,
+                total,
+                local_basename,
+                remote_basename,
+                port,
+                baudrate,
+                **data
+            ), queue=queue)
+        except PortBusyError:
+            # the stream handler answers 409
+            self.job_registry.remove(job)
+            raise
+
+        return source, job
+
+    def _stream_overrides(self, args):
+        """
+        Query arguments arrive as strings, convert them to the type of the setting they override.
+        """
+        defaults = self.get_settings_defaults()
+        data = dict()
+        for key, value in args.items():
+            default = defaults.get(key)
+            if key == "baudrate":
+                value = int(value)
+            elif isinstance(default, bool):
+                value = value.lower() in ("1", "true", "yes", "on")
+            elif isinstance(default, int):
+                value = int(value)
+            data[key] = value
+        return data
+
+    def _start_broadcast(self, local_path, targets, **data):
+        """
+        Sends local_path to every target, each on its own port and as its own job. The file
+        is read once and shared by all of them. Properties of a target override those of the
+        command for that target. A busy target is reported and the others are started.
+        """
+        local_basename, remote_basename, disk_path = self._resolve_paths(local_path)
+        payload = SharedPayload(disk_path)
+        broadcast = Broadcast(local_path, remote_basename)
+        self.bft_logger.info("Broadcasting %s to %s on %s printers" % (local_path, remote_basename, len(targets)))
+
+        for target in targets:
+            overrides = dict(data, **target)
+            # OctoPrint has a single printer connection, only reconnect it where asked to
+            overrides.setdefault("reconnect", False)
+            port = overrides.pop("port")
+            baudrate = overrides.pop("baudrate")
+            job = TransferJob("start_broadcast", port, baudrate, [local_path])
+            job.remote_names = [remote_basename]
+            handler = JobHandler(job, self._create_handler(overrides.get("handler_type")))
+            try:
+                queue = self._check_port(port, overrides)
+                handler.fire_changed(Phase.PreConnect, local_path)
+                process = Process(self._logger, self._settings, self.bft_logger, self.payload_cache, self.resume_store,
+                                  self.reconnector, self.history, self.metrics, self.profile_folder)
+                self.job_registry.add(job)
+                # the port may have become busy since it was checked
+                self.scheduler.submit(port, self._shared_transfer(process, handler, payload, local_basename, remote_basename,
+                                                                  port, baudrate, local_path, overrides), queue=queue)
+            except PortBusyError as exc:
+                self.job_registry.remove(job)
+                self.bft_logger.warn("Not broadcasting to %s: %s" % (port, exc))
+                broadcast.add(port, baudrate, error=str(exc))
+                continue
+            broadcast.add(port, baudrate, job)
+
+        self.broadcasts.add(broadcast)
+        return broadcast
+
+    @staticmethod
+    def _shared_transfer(process, handler, payload, local_basename, remote_basename, port, baudrate, local_path, data):
+        # bind the arguments of this target now, the loop in _start_broadcast moves on
+        return lambda: process.start_shared(handler, payload, local_basename, remote_basename, port, baudrate,
+                                            local_path, **data)
+
+    def _start_batch_binary_transfer(self, handler, port, baudrate, local_paths, **data):
+        self._logger.info(data)
+        queue = self._check_port(port, data)
+
+        handler.fire_changed(Phase.PreConnect, local_paths)
+
+        files = []
+        for local_path in local_paths:
+            local_basename, remote_basename, disk_path = self._resolve_paths(local_path)
+            if remote_basename in [f[2] for f in files]:
+                self.bft_logger.warn("%s will overwrite an earlier file in the batch as %s on remote" % (local_path, remote_basename))
+            files.append((local_path, local_basename, remote_basename, disk_path))
+        self.bft_logger.info("Starting batch transfer of %s files to %s on remote" % (len(files), ", ".join(f[2] for f in files)))
+
+        process = Process(self._logger, self._settings, self.bft_logger, self.payload_cache, self.resume_store,
+                          self.reconnector, self.history, self.metrics, self.profile_folder)
+        self.scheduler.submit(port, lambda: process.start_batch(
+            handler,
+            files,
+            port,
+            baudrate,
+            **data
+        ), queue=queue)
+
+        return [f[2] for f in files]
+
+    def _start_sync_folder(self, handler, port, baudrate, **data):
+        self._logger.info(data)
+        queue = self._check_port(port, data)
+
+        folder = self._settings.get(Setting.UploadFolder)
+        folder_on_disk = self._file_manager.path_on_disk("local", folder)
+        local_paths = []
+        if os.path.isdir(folder_on_disk):
+            local_paths = sorted(folder + "/" + name for name in os.listdir(folder_on_disk)
+                                 if not name.startswith(".") and os.path.isfile(os.path.join(folder_on_disk, name)))
+
+        handler.fire_changed(Phase.PreConnect, local_paths)
+
+        files = []
+        for local_path in local_paths:
+            local_basename, remote_basename, disk_path = self._resolve_paths(local_path)
+            files.append((local_path, local_basename, remote_basename, disk_path))
+        self.bft_logger.info("Syncing %s files in %s" % (len(files), folder))
+
+        process = Process(self._logger, self._settings, self.bft_logger, self.payload_cache, self.resume_store,
+                          self.reconnector, self.history, self.metrics, self.profile_folder)
+        self.scheduler.submit(port, lambda: process.start_sync(
+            handler,
+            files,
+            port,
+            baudrate,
+            self.sync_manifest,
+            **data
+        ), queue=queue)
+
+        return local_paths
+
+    def _check_port(self, port, data):
+        queue = data.get("queue_busy_port", self._settings.get_boolean(Setting.QueueBusyPort))
+        if not queue and self.scheduler.busy(port):
+            raise PortBusyError(port)
+        return queue
+
+    def _resolve_paths(self, local_path):
+        local_basename, remote_basename = self._remote_name(local_path)
+
+        disk_path = self._file_manager.path_on_disk("local", local_path)
+        self._logger.info("Path on disk '%s'" % disk_path)
+        return local_basename, remote_basename, disk_path
+
+    def _remote_name(self, local_path):
+        _, local_basename = os.path.split(local_path)
+        root, ext = os.path.splitext(local_basename)
+        return local_basename, os.path.basename(root)[:8] + ext[:4]
+
     def _fire_phase_changed(self, curr, msg=None):
         self._logger.info(
             "Firing phase change (%s -> %s): %s" % (self._settings.get(Setting.Phase), curr, msg))
@@ -185,6 +490,38 @@ class MarlinbftPlugin(octoprint.plugin.StartupPlugin,
                     marlinbin=accept.split(",")
                 ))
 
+    ##~~ server.http hooks
+
+    def on_server_routes(self, server_routes, *args, **kwargs):
+        from octoprint.server import app
+        from octoprint.server.util.tornado import access_validation_factory
+        from octoprint.server.util.flask import permission_validator
+        from octoprint.access.permissions import Permissions
+
+        return [
+            (r"/stream", StreamTransferHandler, dict(
+                start=self._start_stream_transfer,
+                access_validation=access_validation_factory(app, permission_validator, Permissions.FILES_UPLOAD)
+            ))
+        ]
+
+    def on_server_bodysize(self, current_max_body_sizes, *args, **kwargs):
+        return [("POST", r"/stream", self._settings.global_get_int(["server", "uploads", "maxSize"]))]
+
+    ##~~ BlueprintPlugin
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.Response(self.metrics.expose(), mimetype=None, content_type=Metrics.content_type)
+
+    @octoprint.plugin.BlueprintPlugin.route("/log", methods=["GET"])
+    def get_message_log(self):
+        return flask.Response(self.message_log.read(), mimetype="text/plain",
+                              headers={"Content-Disposition": "attachment; filename=marlinbft.log"})
+
+    def is_blueprint_csrf_protected(self):
+        return True
+
     ##~~ softwareupdate hook
 
     def get_update_information(self):
@@ -225,4 +562,6 @@ def __plugin_load__():
         "octoprint.comm.protocol.firmware.capabilities": __plugin_implementation__.on_firmware_capability,
         "octoprint.events.register_custom_events": __plugin_implementation__.on_register_events,
         "octoprint.filemanager.extension_tree": __plugin_implementation__.on_get_extension_tree,
+        "octoprint.server.http.routes": __plugin_implementation__.on_server_routes,
+        "octoprint.server.http.bodysize": __plugin_implementation__.on_server_bodysize,
     }
@@ -0,0 +1,116 @@
+"""
+Marlin Binary File Transfer Baud Rate Escalation
+"""
+from __future__ import absolute_import, unicode_literals
+
+from serial import SerialException
+from octoprint_marlinbft.readiness import ReadinessProbe
+from time import sleep
+
+
+class BaudRateEscalation(object):
+    """
+    Switches the firmware to a faster baud rate for a transfer and back afterwards. The
+    firmware is asked to switch with gcode (M575), the port is reopened at the new rate and
+    the link is verified with a readiness probe. Marlin answers M575 at the new rate, so the
+    command is not waited for. If the firmware does not answer at the new rate the port is
+    reopened at the original rate; if it does not answer there either it is asked to switch
+    back at the new rate, in case it switched but the link cannot carry that rate.
+
+    open_protocol(baudrate) opens a protocol on the port at baudrate.
+    """
+
+    # time for the firmware to read the command and reconfigure its serial port
+    switch_delay = 0.1
+
+    def __init__(self, open_protocol, logger, gcode="M575 B{baudrate}", probe_gcode="M105", probe_interval_ms=250,
+                 probe_timeout_ms=2000):
+        self.open_protocol = open_protocol
+        self.logger = logger
+        self.gcode = gcode
+        self.probe_gcode = probe_gcode
+        self.probe_interval_ms = probe_interval_ms
+        self.probe_timeout_ms = probe_timeout_ms
+        self.original = None
+
+    @property
+    def escalated(self):
+        return self.original is not None
+
+    def escalate(self, protocol, baudrate):
+        """
+        Returns the protocol to transfer with, at baudrate if the switch worked and at the
+        original rate otherwise.
+        """
+        original = protocol.baud
+        if not baudrate or baudrate == original:
+            return protocol
+
+        self.logger.info("Switching from %s to %s baud" % (original, baudrate))
+        protocol = self._switch(protocol, baudrate)
+        if protocol and self._probe(protocol):
+            self.logger.info("Firmware answers at %s baud" % baudrate)
+            self.original = original
+            return protocol
+
+        self.logger.warn("Firmware does not answer at %s baud, staying at %s baud" % (baudrate, original))
+        fallback = self._reopen(protocol, original)
+        if fallback and self._probe(fallback):
+            return fallback
+
+        # the firmware may have switched even though the link does not work at the new rate
+        protocol = self._reopen(fallback, baudrate)
+        if protocol:
+            protocol = self._switch(protocol, original)
+        return protocol or self.open_protocol(original)
+
+    def restore(self, protocol):
+        """
+        Switches the firmware back to the original rate. Returns the protocol at that rate.
+        """
+        if not self.escalated:
+            return protocol
+        original, self.original = self.original, None
+
+        self.logger.info("Switching back to %s baud" % original)
+        restored = self._switch(protocol, original)
+        try:
+            answers = restored and self._probe(restored)
+        except Exception:
+            self._close(restored)
+            raise
+        if answers:
+            return restored
+        self.logger.warn("Firmware does not answer at %s baud after switching back" % original)
+        return restored or self.open_protocol(original)
+
+    def _switch(self, protocol, baudrate):
+        try:
+            protocol.send_ascii_no_wait(self.gcode.format(baudrate=baudrate))
+            protocol.port.flush()
+        except SerialException as exc:
+            self.logger.warn("Could not ask the firmware to switch to %s baud: %s" % (baudrate, exc))
+        sleep(self.switch_delay)
+        return self._reopen(protocol, baudrate)
+
+    def _reopen(self, protocol, baudrate):
+        if protocol:
+            self._close(protocol)
+        try:
+            return self.open_protocol(baudrate)
+        except SerialException as exc:
+            self.logger.warn("Could not open the port at %s baud: %s" % (baudrate, exc))
+            return None
+
+    def _probe(self, protocol):
+        probe = ReadinessProbe(protocol, self.logger, self.probe_gcode, self.probe_interval_ms)
+        return probe.wait(self.probe_timeout_ms) is not None
+
+    @staticmethod
+    def _close(protocol):
+        # wake the receive worker from readline so the port is closed right away
+        protocol.connected = False
+        cancel_read = getattr(protocol.port, "cancel_read", None)
+        if cancel_read:
+            cancel_read()
+        protocol.shutdown()
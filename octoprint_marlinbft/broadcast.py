@@ -0,0 +1,80 @@
+"""
+Marlin Binary File Transfer Broadcast
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import threading
+import uuid
+
+try:
+    import heatshrink
+except ImportError:
+    import heatshrink2 as heatshrink
+
+from octoprint_marlinbft.compression import slice_samples
+
+
+class SharedPayload(object):
+    """
+    The file of a broadcast, read once and shared by the transfers to every target. The bytes
+    are never modified, so the transfers read them without locking. The compressed form is
+    made by the first transfer that needs it for a window and lookahead, the others wait for
+    it instead of compressing the file again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.size = len(self.data)
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        self._compressed = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        return slice_samples(self.data)
+
+    def compressed(self, window, lookahead):
+        with self._lock:
+            key = (window, lookahead)
+            if key not in self._compressed:
+                self._compressed[key] = heatshrink.encode(self.data, window_sz2=window, lookahead_sz2=lookahead)
+            return self._compressed[key]
+
+    @staticmethod
+    def chunks(data, chunk_size):
+        """
+        Yields views of data instead of copies, so every target reads the same buffer.
+        """
+        view = memoryview(data)
+        for offset in range(0, len(data), chunk_size):
+            yield view[offset:offset + chunk_size]
+
+
+class Broadcast(object):
+    """
+    The jobs that send one file to several printers, so they can be looked up together.
+    """
+
+    def __init__(self, local_path, remote_name):
+        self.id = uuid.uuid4().hex
+        self.local_path = local_path
+        self.remote_name = remote_name
+        self.targets = []
+
+    def add(self, port, baudrate, job=None, error=None):
+        self.targets.append(dict(port=port, baudrate=baudrate, job=job, error=error))
+
+    def to_dict(self, output=False):
+        return dict(
+            id          = self.id,
+            local_path  = self.local_path,
+            remote_name = self.remote_name,
+            targets     = [dict(port     = target["port"],
+                                baudrate = target["baudrate"],
+                                job_id   = target["job"].id if target["job"] else None,
+                                error    = target["error"],
+                                job      = target["job"].to_dict(output) if target["job"] else None)
+                           for target in self.targets],
+        )
@@ -0,0 +1,153 @@
+"""
+Marlin Binary File Transfer Payload Cache
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import os
+import threading
+
+_replace = getattr(os, "replace", os.rename)
+
+
+class PayloadCache(object):
+    """
+    On-disk cache of compressed transfer payloads, keyed by the content hash of the source
+    and the compression parameters. Hashes of local files are kept by size and modification
+    time, so an unchanged file is only read once to look it up. Least recently used entries
+    are evicted once the cache grows beyond its size limit.
+    """
+
+    suffix = ".hs"
+
+    def __init__(self, folder, logger):
+        self.folder = folder
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._hashes = {}
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def digest_file(self, path):
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime):
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                sha.update(chunk)
+        with self._lock:
+            self._hashes[path] = ((stat.st_size, stat.st_mtime), sha.hexdigest())
+        return sha.hexdigest()
+
+    def key(self, digest, window, lookahead):
+        return "%s-w%s-l%s" % (digest, window, lookahead)
+
+    def find(self, key):
+        """
+        Returns the payload stored under key opened for reading and its size, or None if it
+        is not cached. The payload is opened under the cache lock, so another transfer
+        evicting it afterwards does not take it away from the caller, who has to close it.
+        """
+        path = self._path(key)
+        with self._lock:
+            try:
+                f = open(path, "rb")
+            except (IOError, OSError):
+                self.misses += 1
+                return None
+            try:
+                size = os.fstat(f.fileno()).st_size
+                os.utime(path, None)
+            except (IOError, OSError):
+                f.close()
+                self.misses += 1
+                return None
+            self.hits += 1
+            return f, size
+
+    def put_file(self, key, temp_path, max_bytes):
+        """
+        Moves the payload in temp_path, which must be in the cache folder, into the cache.
+        """
+        with self._lock:
+            try:
+                if os.path.getsize(temp_path) > max_bytes:
+                    self.logger.debug("Payload %s is larger than the cache, not storing" % key)
+                    os.remove(temp_path)
+                    return
+                _replace(temp_path, self._path(key))
+            except (IOError, OSError) as exc:
+                self.logger.warn("Could not store payload %s in cache: %s" % (key, exc))
+                return
+            self._evict(max_bytes)
+
+    def spool(self):
+        """
+        Returns a PayloadSpool that writes a payload to disk as it is produced, for payloads
+        whose source is only known once it has been read completely.
+        """
+        return PayloadSpool(self)
+
+    def stats(self):
+        return "hits: %s, misses: %s" % (self.hits, self.misses)
+
+    def _evict(self, max_bytes):
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(self.suffix):
+                continue
+            stat = os.stat(os.path.join(self.folder, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError as exc:
+                # on Windows a payload that is being sent cannot be removed
+                self.logger.debug("Could not evict %s from payload cache: %s" % (name, exc))
+                continue
+            total -= size
+            self.logger.debug("Evicted %s from payload cache" % name)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + self.suffix)
+
+
+class PayloadSpool(object):
+    """
+    Hashes the source and writes the payload to a temporary file in the cache folder while a
+    transfer produces them, then stores the payload under the source's key on commit.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.path = os.path.join(cache.folder, "spool.%s.%s.tmp" % (os.getpid(), threading.current_thread().ident))
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def update(self, source, payload):
+        self._sha.update(source)
+        self._file.write(payload)
+        self.size += len(payload)
+
+    def commit(self, window, lookahead, max_bytes):
+        self._file.close()
+        self.cache.put_file(self.cache.key(self._sha.hexdigest(), window, lookahead), self.path, max_bytes)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
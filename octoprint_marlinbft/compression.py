@@ -0,0 +1,83 @@
+"""
+Marlin Binary File Transfer Compression Estimate
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+try:
+    import heatshrink
+except ImportError:
+    import heatshrink2 as heatshrink
+
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+# every block is framed by an 8 byte header and a 2 byte checksum
+BLOCK_OVERHEAD = 10
+# a start bit, 8 data bits and a stop bit per byte
+BITS_PER_BYTE = 10
+
+
+def read_samples(filename, filesize, sample_size=16 * 1024, count=3):
+    """
+    Reads count samples of sample_size bytes spread evenly over the file, the whole file if it
+    is not larger than all samples together.
+    """
+    with open(filename, "rb") as f:
+        if filesize <= sample_size * count:
+            return [f.read()]
+
+        samples = []
+        for offset in _sample_offsets(filesize, sample_size, count):
+            f.seek(offset)
+            samples.append(f.read(sample_size))
+        return samples
+
+
+def slice_samples(data, sample_size=16 * 1024, count=3):
+    """
+    Like read_samples, for a payload that is already in memory.
+    """
+    if len(data) <= sample_size * count:
+        return [data]
+    return [data[offset:offset + sample_size] for offset in _sample_offsets(len(data), sample_size, count)]
+
+
+def _sample_offsets(size, sample_size, count):
+    step = (size - sample_size) // (count - 1) if count > 1 else 0
+    return [i * step for i in range(count)]
+
+
+class CompressionEstimate(object):
+    """
+    Predicts whether compressing a payload of size bytes saves time on a link of baudrate,
+    from the compression ratio and speed measured on samples of it. Compression pays off if
+    compressing and sending the smaller payload is faster than sending it as it is.
+    """
+
+    def __init__(self, samples, size, baudrate, block_size, window, lookahead):
+        raw = sum(len(sample) for sample in samples)
+        start_pc = perf_counter()
+        compressed = sum(len(heatshrink.encode(sample, window_sz2=window, lookahead_sz2=lookahead)) for sample in samples)
+        elapsed = max(perf_counter() - start_pc, 1e-6)
+
+        self.size = size
+        self.ratio = compressed / raw if raw else 1.0
+        self.compress_rate = raw / elapsed
+        self.raw_time = self._wire_time(size, baudrate, block_size)
+        self.compressed_time = size / self.compress_rate + self._wire_time(int(size * self.ratio), baudrate, block_size)
+
+    @property
+    def compress(self):
+        return self.compressed_time < self.raw_time
+
+    @staticmethod
+    def _wire_time(size, baudrate, block_size):
+        blocks = -(-size // block_size)
+        return (size + blocks * BLOCK_OVERHEAD) * BITS_PER_BYTE / baudrate
+
+    def __str__(self):
+        return "ratio {0:.2f}, compressing at {1:.0f}KiB/s, raw {2:.2f}s, compressed {3:.2f}s".format(
+            self.ratio, self.compress_rate / 1024, self.raw_time, self.compressed_time)
@@ -0,0 +1,652 @@
+"""
+Marlin Binary File Transfer Protocol Extensions
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import itertools
+import os
+import struct
+import time
+
+from binproto2 import ConnectionLost, FatalError, FileTransferProtocol, ReadTimeout
+from octoprint_marlinbft.compression import CompressionEstimate, read_samples
+from octoprint_marlinbft.pipeline import PipelinedWriter
+from octoprint_marlinbft.utils import Compression
+
+try:
+    import heatshrink
+except ImportError:
+    import heatshrink2 as heatshrink
+
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+
+def read_chunks(filename, chunk_size, offset=0):
+    """
+    Yields the file from offset on in chunks of at most chunk_size bytes.
+    """
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+
+class FixedBlockSize(object):
+    def __init__(self, size):
+        self.size = int(size)
+
+    def record(self, retries):
+        pass
+
+
+class AdaptiveBlockSize(object):
+    """
+    Doubles the block size after a run of cleanly acknowledged blocks and halves it
+    once retries accumulate, staying within [minimum, maximum]. The maximum is the largest
+    block the firmware accepts, which is also where a transfer starts by default, so on a
+    clean link the size stays there: it backs off on a noisy link and grows back afterwards.
+    """
+
+    def __init__(self, initial, minimum, maximum, grow_after=16, shrink_after=3):
+        self.maximum = int(maximum)
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.grow_after = grow_after
+        self.shrink_after = shrink_after
+        self.size = self.minimum
+        self._resize(int(initial))
+
+    def record(self, retries):
+        if retries:
+            self.clean = 0
+            self.retries += retries
+            if self.retries >= self.shrink_after:
+                self._resize(self.size // 2)
+        else:
+            self.clean += 1
+            if self.clean >= self.grow_after:
+                self._resize(self.size * 2)
+
+    def _resize(self, size):
+        self.size = max(self.minimum, min(size, self.maximum))
+        self.clean = 0
+        self.retries = 0
+
+
+class RetransmissionTimer(object):
+    """
+    Measures the round trip time of acknowledged blocks and, if adaptive, derives the time
+    to wait for an acknowledgement from it like TCP does (RFC 6298): the smoothed round trip
+    plus four times its smoothed deviation, within [floor, ceiling]. Blocks that were sent
+    more than once are not measured, their acknowledgement may answer any of the sends
+    (Karn's algorithm). A timeout doubles the wait until the next measurement. Without
+    adaptive the wait stays at initial and the round trips are only measured.
+
+    All times are in milliseconds, like comm_timeout_ms.
+    """
+
+    alpha = 1 / 8
+    beta = 1 / 4
+    # polling granularity, the wait is never closer than this to the smoothed round trip
+    granularity = 1.0
+
+    def __init__(self, initial, floor, ceiling, adaptive=True):
+        self.initial = float(initial)
+        self.floor = float(floor)
+        self.ceiling = max(self.floor, float(ceiling))
+        self.adaptive = adaptive
+        self.timeout = self._clamp(self.initial) if adaptive else self.initial
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.skipped = 0
+        self.backoffs = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @property
+    def give_up(self):
+        # as long as binproto2 waits at the fixed timeout before the link is considered lost
+        return self.initial * 20
+
+    def record(self, rtt, retries):
+        if retries:
+            self.skipped += 1
+            return
+        self.samples += 1
+        self.total += rtt
+        self.min = rtt if self.min is None else min(self.min, rtt)
+        self.max = rtt if self.max is None else max(self.max, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        if self.adaptive:
+            self.timeout = self._clamp(self.srtt + max(self.granularity, 4 * self.rttvar))
+
+    def backoff(self):
+        self.backoffs += 1
+        if self.adaptive:
+            self.timeout = self._clamp(self.timeout * 2)
+
+    def stats(self):
+        def ms(value):
+            return round(value, 1) if value is not None else None
+        return dict(
+            samples    = self.samples,
+            skipped    = self.skipped,
+            min_ms     = ms(self.min),
+            mean_ms    = ms(self.total / self.samples) if self.samples else None,
+            max_ms     = ms(self.max),
+            srtt_ms    = ms(self.srtt),
+            rttvar_ms  = ms(self.rttvar),
+            timeout_ms = ms(self.timeout),
+            backoffs   = self.backoffs,
+            adaptive   = self.adaptive,
+        )
+
+    def _clamp(self, timeout):
+        return max(self.floor, min(timeout, self.ceiling))
+
+
+class BftFileTransfer(FileTransferProtocol):
+    """
+    FileTransferProtocol whose copy loop asks a block sizer for the size of every block
+    instead of using the fixed protocol block size.
+
+    Firmware may advertise protocol extensions as extra fields after the compression field of
+    the version response, e.g. "PFT:version:0.1.0:compression:none:resume". With the "resume"
+    extension an uncompressed transfer can be continued from the last acknowledged offset.
+    With "window,<n>" the firmware buffers up to n write packets, and pipeline_window blocks
+    (at most n) are sent without waiting for each acknowledgement.
+
+    With an adaptive timer every block waits for its acknowledgement as long as the timer
+    says instead of the protocol's fixed response timeout.
+    """
+
+    RESUME = "resume"
+    WINDOW = "window"
+
+    sample_size = 48 * 1024
+
+    def __init__(self, protocol, block_sizer=None, payload_cache=None, cache_max_bytes=0, progress=None,
+                 progress_interval=0.5, chunk_size=64 * 1024, timeout=None, logger=None, metrics=None,
+                 pipeline_window=0, timer=None, timeline=None):
+        super(BftFileTransfer, self).__init__(protocol, timeout, logger)
+        self.chunk_size = max(1, int(chunk_size))
+        self.block_sizer = block_sizer or FixedBlockSize(protocol.block_size)
+        self.payload_cache = payload_cache
+        self.cache_max_bytes = cache_max_bytes
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.metrics = metrics
+        self.pipeline_window = pipeline_window
+        self.pipeline = None
+        self._meter = None
+        self.timer = timer
+        self.timeline = timeline
+        self.extensions = set()
+        self.acknowledged = 0
+        self.resumable = False
+        self._reset_stats(None)
+
+    def connect(self):
+        self.protocol._send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
+
+        token, data = self._await_response()
+        if token != 'PFT:version:':
+            return False
+
+        fields = data.split(':')
+        self.version, compression = fields[0], fields[2]
+        self.extensions = set(fields[3:])
+        if compression != 'none':
+            algorithm, window, lookahead = compression.split(',')
+            self.compression = {'algorithm': algorithm, 'window': int(window), 'lookahead': int(lookahead)}
+        else:
+            self.compression = {'algorithm': 'none'}
+
+        self.logger.info("File Transfer version: {0}, compression: {1}, extensions: {2}".format(
+            self.version, self.compression['algorithm'], ", ".join(sorted(self.extensions)) or "none"))
+
+    def open(self, filename, compression, dummy, offset=0):
+        if not offset:
+            return super(BftFileTransfer, self).open(filename, compression, dummy)
+
+        payload = b'\1' if dummy else b'\0'
+        payload += b'\1' if compression else b'\0'
+        payload += bytearray(filename, 'utf8') + b'\0'
+        payload += struct.pack("<I", offset)          # resume extension: continue writing at offset
+
+        self.protocol._send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+        deadline = perf_counter() + 5
+        while perf_counter() < deadline:
+            try:
+                token, _ = self._await_response(1000)
+            except ReadTimeout:
+                continue
+            if token == 'PFT:success':
+                self.logger.info("Reopened file: {0} at offset {1}".format(filename, offset))
+                return
+            elif token == 'PFT:busy':
+                self.logger.info("Broken transfer detected, closing it before resuming")
+                self.close()
+                time.sleep(0.1)
+                self.protocol._send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+            elif token == 'PFT:fail':
+                raise Exception("Cannot reopen file on client")
+        raise ReadTimeout()
+
+    def copy(self, filename, dest_filename, compression, dummy, resume_offset=0):
+        """
+        compression is True, False or Compression.Auto to compress only if it is predicted
+        to make the transfer faster. The file is read, compressed and sent chunk_size bytes
+        at a time, so memory use does not depend on its size.
+        """
+        # nothing of this file is acknowledged until its blocks are sent, an error before
+        # that must not leave the offset of the previous file to resume this one at
+        self.resumable = False
+        self.acknowledged = 0
+        filesize = os.path.getsize(filename)
+        self._reset_stats(filesize)
+        self.connect()
+
+        if resume_offset and self._can_resume(resume_offset, filesize):
+            compression_support = False
+        else:
+            resume_offset = 0
+            compression_support = self._use_compression(compression, filesize, lambda: read_samples(filename, filesize))
+
+        self.open(dest_filename, compression_support, dummy, resume_offset)
+        self.stats["compression"] = compression_support
+
+        cached = self._cached_payload(filename) if compression_support else None
+        if cached:
+            digest, payload, size = cached
+            self.stats["hash"] = digest
+            with payload:
+                self._send(iter(lambda: payload.read(self.chunk_size), b""), dest_filename, filesize, digest=False,
+                           payload_size=size)
+        else:
+            # a compressed stream cannot be restarted in the middle, only raw offsets are worth keeping
+            self.resumable = self.RESUME in self.extensions and not compression_support and not dummy
+            self.stats["hash"] = self._send(read_chunks(filename, self.chunk_size, resume_offset), dest_filename, filesize,
+                                            compression_support, offset=resume_offset)
+
+        self.close()
+
+        self.logger.info("Transfer complete")
+
+    def copy_stream(self, source, dest_filename, compression, dummy, total=None, cache=True):
+        """
+        Copies the chunks the iterable source yields while they arrive, compressing them
+        incrementally. total is the expected number of source bytes and is only used to
+        report progress. A stream cannot be rewound, so it is never resumable. With a payload
+        cache and cache set the compressed payload is stored as it is sent, so a later
+        transfer of the same content does not compress it again.
+        """
+        self.resumable = False
+        self.acknowledged = 0
+        self._reset_stats(total)
+        self.connect()
+
+        # in auto mode the decision is made on the start of the stream
+        source = iter(source)
+        head = self._peek(source, self.sample_size) if compression == Compression.Auto else []
+        compression_support = self._use_compression(compression, total or sum(len(chunk) for chunk in head),
+                                                    lambda: [b"".join(head)])
+
+        self.open(dest_filename, compression_support, dummy)
+        self.stats["compression"] = compression_support
+        self.stats["hash"] = self._send(itertools.chain(head, source), dest_filename, total, compression_support,
+                                        cache=cache)
+        self.close()
+
+        self.logger.info("Transfer complete")
+
+    def copy_shared(self, payload, dest_filename, compression, dummy):
+        """
+        Copies a SharedPayload. The payload is compressed at most once for all the transfers
+        that share it, and sent from memory without copying it.
+        """
+        self.resumable = False
+        self.acknowledged = 0
+        self._reset_stats(payload.size)
+        self.connect()
+
+        compression_support = self._use_compression(compression, payload.size, payload.samples)
+        self.open(dest_filename, compression_support, dummy)
+        self.stats.update(compression=compression_support, hash=payload.digest)
+
+        data = payload.data
+        if compression_support:
+            data = payload.compressed(self.compression['window'], self.compression['lookahead'])
+        self._send(payload.chunks(data, self.chunk_size), dest_filename, payload.size, digest=False,
+                   payload_size=len(data) if compression_support else None)
+        self.close()
+
+        self.logger.info("Transfer complete")
+
+    def _send(self, chunks, dest_filename, total, compress=False, offset=0, digest=True, payload_size=None, cache=True):
+        """
+        Frames the chunks into blocks and writes them, compressing them on the way if compress
+        is set, and storing the compressed payload in the payload cache if cache is set. acknowledged counts the bytes of the acknowledged blocks from offset, progress
+        the source bytes they carry. If the chunks are a payload that is already compressed,
+        payload_size is its size and total the size of its source, so progress still counts
+        source bytes. At most one chunk, its compressed form and one block are held at a time.
+        Returns the sha256 of the source if digest is set and it was sent from the start.
+        """
+        encoder = self._encoder() if compress else None
+        spool = self.payload_cache.spool() if self.payload_cache and cache and compress and not offset else None
+        sha = hashlib.sha256() if digest and not offset else None
+        meter = self._meter = _ProgressMeter(self, dest_filename, total, offset)
+        self.acknowledged = offset
+        pending = bytearray()
+        received = offset
+        errors = self.protocol.errors
+        start_pc = perf_counter()
+        self.pipeline = self._pipeline()
+        try:
+            mark = start_pc
+            for chunk in chunks:
+                received += len(chunk)
+                if sha:
+                    sha.update(chunk)
+                mark = self._lap("read", mark)
+                payload = encoder.fill(chunk) if encoder else chunk
+                if spool:
+                    spool.update(chunk, payload)
+                if encoder:
+                    mark = self._lap("compression", mark)
+                meter.read(received * total // payload_size if payload_size else received, len(payload))
+                pending = self._write_blocks(pending + payload)
+                mark = self._lap("block_transfer", mark)
+
+            if encoder:
+                payload = encoder.finish()
+                if spool:
+                    spool.update(b"", payload)
+                pending += payload
+                meter.read(received, len(payload))
+                mark = self._lap("compression", mark)
+            self._write_blocks(pending, final=True)
+            if self.pipeline:
+                self.pipeline.flush()
+            meter.finish()
+            self._lap("block_transfer", mark)
+        except BaseException:
+            if spool:
+                spool.discard()
+            if self.pipeline:
+                self.pipeline.release()
+            raise
+        finally:
+            self.pipeline = None
+            self._meter = None
+            self.stats.update(retries=self.protocol.errors - errors, elapsed=perf_counter() - start_pc,
+                              block_size=self.block_sizer.size)
+            if total is None:
+                self.stats["size"] = received
+
+        if spool:
+            spool.commit(self.compression['window'], self.compression['lookahead'], self.cache_max_bytes)
+            self.logger.info("Payload cache miss, stored {0} bytes ({1})".format(spool.size, self.payload_cache.stats()))
+        return sha.hexdigest() if sha else None
+
+    def _lap(self, step, mark):
+        """
+        Adds the time since mark to step of the timeline and returns the new mark.
+        """
+        now = perf_counter()
+        if self.timeline:
+            self.timeline.add(step, mark, now - mark)
+        return now
+
+    def _use_compression(self, compression, size, samples):
+        """
+        Decides whether to compress a payload of size bytes. samples returns samples of the
+        source and is only called in auto mode.
+        """
+        if not compression:
+            return False
+        if self.compression['algorithm'] != 'heatshrink':
+            if compression != Compression.Auto:
+                self.logger.warn("Compression not supported by client")
+            return False
+        if compression != Compression.Auto:
+            return True
+        if not size:
+            return False
+
+        estimate = CompressionEstimate(samples(), size, self.protocol.baud, self.block_sizer.size,
+                                       self.compression['window'], self.compression['lookahead'])
+        self.logger.info("Auto compression {0}: {1}".format("on" if estimate.compress else "off", estimate))
+        return estimate.compress
+
+    @staticmethod
+    def _peek(source, size):
+        head = []
+        for chunk in source:
+            head.append(chunk)
+            size -= len(chunk)
+            if size <= 0:
+                break
+        return head
+
+    def _write_blocks(self, pending, final=False):
+        """
+        Writes full blocks from pending, and the remainder too if final, and returns what is
+        left.
+        """
+        offset = 0
+        while len(pending) - offset >= self.block_sizer.size or (final and offset < len(pending)):
+            block_size = self.block_sizer.size
+            block = bytes(pending[offset:offset + block_size])
+            self._write_block(block)
+            offset += len(block)
+        return pending[offset:]
+
+    def _write_block(self, block):
+        if self.pipeline:
+            self.pipeline.write(block)
+            return
+        errors = self.protocol.errors
+        start_pc = perf_counter()
+        if self.timer and self.timer.adaptive:
+            self._write_timed(block)
+        else:
+            self.write(block)
+        self._acknowledge(block, perf_counter() - start_pc, self.protocol.errors - errors)
+
+    def _write_timed(self, block):
+        """
+        write, but each send waits as long as the timer says and a timeout backs the timer
+        off. binproto2 would wait the same response timeout for every send and give up
+        after 20 of them.
+        """
+        protocol = self.protocol
+        protocol.packet_transit = protocol._build_packet(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, block)
+        protocol.packet_status = 0
+        protocol.transmit_attempt = 0
+        give_up = perf_counter() + self.timer.give_up / 1000.0
+        try:
+            while protocol.packet_status == 0:
+                if perf_counter() > give_up:
+                    raise ConnectionLost()
+                protocol._transmit_packet(protocol.packet_transit)
+                try:
+                    self._await_ok(perf_counter() + self.timer.timeout / 1000.0)
+                except ReadTimeout:
+                    protocol.errors += 1
+                    protocol.logger.debug("Packet loss detected")
+                    self.timer.backoff()
+        finally:
+            protocol.packet_transit = None
+
+    def _await_ok(self, deadline):
+        """
+        Reads replies until the block with the protocol's sync id is acknowledged, or returns
+        early on a resend request for it. A block that was sent again before its ok arrived
+        is acknowledged twice; like PipelinedWriter, replies for earlier sync ids are dropped,
+        where binproto2 would raise SynchronizationError.
+        """
+        protocol = self.protocol
+        responses = protocol.responses
+        while True:
+            while not responses:
+                time.sleep(0.00001)
+                if perf_counter() > deadline:
+                    raise ReadTimeout()
+            token, data = responses.popleft()
+            if token == "fe":
+                raise FatalError()
+            if token not in ("ok", "rs"):
+                continue
+            try:
+                sync = int(data)
+            except ValueError:
+                continue
+            if sync != protocol.sync:
+                protocol.logger.debug("Dropping stale {0}{1}".format(token, sync))
+                continue
+            if token == "rs":
+                protocol.errors += 1
+                return
+            protocol.sync = (sync + 1) % 256
+            protocol.packet_status = 1
+            return
+
+    def _acknowledge(self, block, rtt, retries):
+        self.acknowledged += len(block)
+        if self._meter:
+            self._meter.update(len(block))
+        if self.metrics:
+            self.metrics.block(len(block), rtt, retries)
+        if self.timer:
+            self.timer.record(rtt * 1000, retries)
+        self.block_sizer.record(retries)
+
+    def _pipeline(self):
+        """
+        A PipelinedWriter if pipelining is enabled and the firmware supports it, otherwise
+        None and blocks are sent stop-and-wait.
+        """
+        if self.pipeline_window <= 1:
+            return None
+        advertised = self.advertised_window()
+        if not advertised:
+            self.logger.info("Firmware does not advertise a receive window, sending blocks one at a time")
+            return None
+        window = min(self.pipeline_window, advertised)
+        self.logger.info("Pipelining up to {0} blocks".format(window))
+        # lost packets are logged like binproto2 does, so they are counted as timeouts too
+        return PipelinedWriter(self.protocol, window, FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE,
+                               self._acknowledge, self.protocol.logger,
+                               self.timer if self.timer and self.timer.adaptive else None)
+
+    def advertised_window(self):
+        for extension in self.extensions:
+            name, _, size = extension.partition(",")
+            if name == self.WINDOW and size.isdigit():
+                return int(size)
+        return 0
+
+    def _encoder(self):
+        return heatshrink.core.Encoder(heatshrink.core.Writer(window_sz2=self.compression['window'],
+                                                              lookahead_sz2=self.compression['lookahead']))
+
+    def _can_resume(self, offset, filesize):
+        if self.RESUME not in self.extensions:
+            self.logger.info("Firmware cannot resume transfers, restarting from the beginning")
+            return False
+        if offset >= filesize:
+            self.logger.info("Resume offset {0} is past the end of the file, restarting from the beginning".format(offset))
+            return False
+        self.logger.info("Resuming transfer at offset {0} of {1}".format(offset, filesize))
+        return True
+
+    def _cached_payload(self, filename):
+        """
+        Returns the digest of the file, its cached payload opened for reading and the size of
+        the payload, or None.
+        """
+        if not self.payload_cache:
+            return None
+        digest = self.payload_cache.digest_file(filename)
+        found = self.payload_cache.find(self.payload_cache.key(digest, self.compression['window'], self.compression['lookahead']))
+        if not found:
+            return None
+        self.logger.info("Payload cache hit ({0})".format(self.payload_cache.stats()))
+        return (digest,) + found
+
+    def _reset_stats(self, size):
+        """
+        stats describe the last copy for the transfer history: source size and sha256,
+        whether it was compressed, the final block size, retries and seconds spent sending.
+        """
+        self.stats = dict(size=size, hash=None, compression=None, block_size=self.block_sizer.size, retries=0, elapsed=0)
+
+
+class _ProgressMeter(object):
+    """
+    Logs every acknowledged block and calls the transfer's progress callback at most every
+    progress_interval, and once more when the last block is acknowledged. Progress counts
+    the source bytes the acknowledged blocks carry: the bytes themselves when the source is
+    sent as it is, and a share of the source read so far in proportion to the compressed
+    bytes acknowledged when it is compressed on the way. total may be unknown for streams.
+    """
+
+    def __init__(self, filetransfer, dest_filename, total, offset=0):
+        self.filetransfer = filetransfer
+        self.dest_filename = dest_filename
+        self.total = total
+        self.offset = offset
+        self.received = offset
+        self.produced = 0
+        self.retries = filetransfer.protocol.errors
+        self.start_pc = perf_counter()
+        self.last_pc = 0
+        self.last_sent = None
+
+    def read(self, received, produced):
+        """
+        Counts the source bytes read so far and the bytes of blocks made from them.
+        """
+        self.received = received
+        self.produced += produced
+
+    def sent(self):
+        acknowledged = self.filetransfer.acknowledged - self.offset
+        source = self.received - self.offset
+        if self.produced and self.produced != source:
+            acknowledged = acknowledged * source // self.produced
+        return self.offset + min(acknowledged, source)
+
+    def finish(self):
+        self.update(None, done=True)
+
+    def update(self, block_size, done=False):
+        filetransfer = self.filetransfer
+        sent = self.received if done else self.sent()
+        now_pc = perf_counter()
+        kibs = ((sent - self.offset) / 1024) / max(now_pc - self.start_pc, 0.001)
+        if block_size:
+            filetransfer.logger.info("PROGRESS: {0} {1:4.2f}KiB/s Block: {2} Errors: {3}".format(
+                "{0:2.2f}%".format(sent * 100 / self.total) if self.total else "{0}B".format(sent), kibs,
+                block_size, filetransfer.protocol.errors))
+
+        due = now_pc - self.last_pc >= filetransfer.progress_interval or (done and sent != self.last_sent)
+        if filetransfer.progress and due:
+            self.last_pc = now_pc
+            self.last_sent = sent
+            throughput = kibs * 1024
+            eta = (self.total - sent) / throughput if throughput and self.total else None
+            filetransfer.progress(self.dest_filename, sent, self.total, throughput,
+                                  filetransfer.protocol.errors - self.retries, eta)
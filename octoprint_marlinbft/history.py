@@ -0,0 +1,152 @@
+"""
+Marlin Binary File Transfer History
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import sqlite3
+import threading
+import time
+
+DAY = 24 * 60 * 60
+
+
+class TransferHistory(object):
+    """
+    Every file transfer attempt, stored in an sqlite database, with statistics per printer.
+    A printer is identified by the key Process uses for it, the printer profile and port.
+    Entries older than retention_days are removed as new ones are recorded.
+    """
+
+    columns = ("job_id", "time", "printer", "port", "baudrate", "file", "remote_name", "size", "hash",
+               "block_size", "compression", "elapsed", "retries", "ok", "error")
+
+    def __init__(self, path, logger, retention_days=365):
+        self.path = path
+        self.logger = logger
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS transfers (
+                    id          INTEGER PRIMARY KEY,
+                    job_id      TEXT,
+                    time        REAL NOT NULL,
+                    printer     TEXT NOT NULL,
+                    port        TEXT,
+                    baudrate    INTEGER,
+                    file        TEXT,
+                    remote_name TEXT,
+                    size        INTEGER,
+                    hash        TEXT,
+                    block_size  INTEGER,
+                    compression INTEGER,
+                    elapsed     REAL,
+                    retries     INTEGER,
+                    ok          INTEGER NOT NULL,
+                    error       TEXT
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS transfers_printer_time ON transfers (printer, time)")
+
+    def record(self, **entry):
+        entry.setdefault("time", time.time())
+        values = [entry.get(column) for column in self.columns]
+        try:
+            with self._lock, self._connect() as db:
+                db.execute("INSERT INTO transfers (%s) VALUES (%s)" % (", ".join(self.columns), ", ".join("?" * len(values))),
+                           values)
+                if self.retention_days:
+                    db.execute("DELETE FROM transfers WHERE time < ?", (time.time() - self.retention_days * DAY,))
+        except sqlite3.Error as exc:
+            self.logger.warn("Could not record transfer in history %s: %s" % (self.path, exc))
+
+    def recent(self, limit=50, printer=None):
+        query = "SELECT %s FROM transfers" % ", ".join(self.columns)
+        args = []
+        if printer:
+            query += " WHERE printer = ?"
+            args.append(printer)
+        query += " ORDER BY time DESC LIMIT ?"
+        args.append(int(limit))
+
+        with self._lock, self._connect() as db:
+            rows = db.execute(query, args).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def stats(self, days=30):
+        """
+        Totals per printer over the last days, and the same figures for each day. Throughput
+        is the bytes of successful transfers divided by the time they took.
+        """
+        since = time.time() - days * DAY
+        aggregates = """
+            COUNT(*),
+            SUM(1 - ok),
+            SUM(CASE WHEN ok THEN size ELSE 0 END),
+            SUM(CASE WHEN ok THEN elapsed ELSE 0 END),
+            SUM(retries),
+            MAX(time)"""
+
+        with self._lock, self._connect() as db:
+            totals = db.execute("SELECT printer, %s FROM transfers WHERE time >= ? GROUP BY printer ORDER BY printer"
+                                % aggregates, (since,)).fetchall()
+            daily = db.execute("SELECT printer, CAST(time / %s AS INTEGER) AS day, %s FROM transfers WHERE time >= ? "
+                               "GROUP BY printer, day ORDER BY printer, day" % (DAY, aggregates), (since,)).fetchall()
+
+        printers = []
+        for row in totals:
+            printer = self._aggregate(row[1:])
+            printer.update(printer=row[0], days=[])
+            printers.append(printer)
+
+        by_printer = dict((printer["printer"], printer) for printer in printers)
+        for row in daily:
+            day = self._aggregate(row[2:])
+            day.update(day=row[1] * DAY)
+            by_printer[row[0]]["days"].append(day)
+        return printers
+
+    @staticmethod
+    def _aggregate(row):
+        transfers, failures, size, elapsed, retries, last = row
+        return dict(
+            transfers    = transfers,
+            failures     = failures or 0,
+            failure_rate = (failures or 0) / transfers if transfers else 0,
+            bytes        = size or 0,
+            seconds      = elapsed or 0,
+            throughput   = size / elapsed if size and elapsed else None,
+            retries      = retries or 0,
+            last         = last,
+        )
+
+    def _entry(self, row):
+        entry = dict(zip(self.columns, row))
+        entry["ok"] = bool(entry["ok"])
+        entry["compression"] = bool(entry["compression"]) if entry["compression"] is not None else None
+        return entry
+
+    def _connect(self):
+        return _Connection(self.path)
+
+
+class _Connection(object):
+    """
+    An sqlite connection that commits and closes when the block ends. Connections are not
+    shared, transfers record from their own threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.path)
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.db.commit()
+        finally:
+            self.db.close()
@@ -0,0 +1,160 @@
+"""
+Marlin Binary File Transfer Jobs
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from octoprint_marlinbft.utils import ApiHandler, Phase
+
+
+class JobStatus:
+    Queued    = "queued"
+    Running   = "running"
+    Succeeded = "succeeded"
+    Failed    = "failed"
+
+
+class TransferJob(object):
+    def __init__(self, command, port, baudrate, local_paths):
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.port = port
+        self.baudrate = baudrate
+        self.local_paths = local_paths
+        self.remote_names = []
+        self.status = JobStatus.Queued
+        self.phase = Phase.PreConnect
+        self.progress = None
+        self.result = None
+        self.output = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self, output=True):
+        job = dict(
+            id           = self.id,
+            command      = self.command,
+            port         = self.port,
+            baudrate     = self.baudrate,
+            local_paths  = self.local_paths,
+            remote_names = self.remote_names,
+            status       = self.status,
+            phase        = self.phase,
+            progress     = self.progress,
+            result       = self.result,
+            created      = self.created,
+            started      = self.started,
+            finished     = self.finished,
+        )
+        if output:
+            job["output"] = list(self.output)
+        return job
+
+
+class JobHandler(ApiHandler):
+    """
+    Records the state and output of a job while passing every callback on to the handler
+    it wraps.
+    """
+
+    def __init__(self, job, inner):
+        super(JobHandler, self).__init__()
+        self.job = job
+        self.inner = inner
+        self.output = job.output
+        self.file_results = []
+
+    def start(self, local_name, remote_name):
+        self.job.status = JobStatus.Running
+        self.job.started = time.time()
+        super(JobHandler, self).start(local_name, remote_name)
+        self.inner.start(local_name, remote_name)
+
+    def success(self, local_name, remote_name, elapsed):
+        self.job.result = dict(ok=True, elapsed=elapsed, files=self._files())
+        super(JobHandler, self).success(local_name, remote_name, elapsed)
+        self.inner.success(local_name, remote_name, elapsed)
+
+    def failure(self, local_name, remote_name, elapsed, msg):
+        self.job.result = dict(ok=False, elapsed=elapsed, error=str(msg), files=self._files())
+        super(JobHandler, self).failure(local_name, remote_name, elapsed, msg)
+        self.inner.failure(local_name, remote_name, elapsed, msg)
+
+    def file_complete(self, local_name, remote_name, elapsed, msg=None):
+        self.file_results.append(dict(local_name=local_name, remote_name=remote_name, elapsed=elapsed,
+                                       ok=not msg, error=str(msg) if msg else None))
+        super(JobHandler, self).file_complete(local_name, remote_name, elapsed, msg)
+        self.inner.file_complete(local_name, remote_name, elapsed, msg)
+
+    def progress(self, remote_name, sent, total, throughput, retries, eta):
+        super(JobHandler, self).progress(remote_name, sent, total, throughput, retries, eta)
+        self.job.progress = self.last_progress
+        self.inner.progress(remote_name, sent, total, throughput, retries, eta)
+
+    def reconnected(self, port, timings):
+        if self.job.result is not None:
+            self.job.result["reconnect"] = timings
+        super(JobHandler, self).reconnected(port, timings)
+        self.inner.reconnected(port, timings)
+
+    def round_trips(self, stats):
+        if self.job.result is not None:
+            self.job.result["round_trips"] = stats
+        super(JobHandler, self).round_trips(stats)
+        self.inner.round_trips(stats)
+
+    def timeline(self, timeline):
+        if self.job.result is not None:
+            self.job.result["timeline"] = timeline
+        super(JobHandler, self).timeline(timeline)
+        self.inner.timeline(timeline)
+
+    def fire_changed(self, current, msg=None):
+        self.job.phase = current
+        if current == Phase.CompleteOK:
+            self.job.status = JobStatus.Succeeded
+        elif current == Phase.CompleteFail:
+            self.job.status = JobStatus.Failed
+        elif current == Phase.Inactive:
+            if self.job.status not in (JobStatus.Succeeded, JobStatus.Failed):
+                self.job.status = JobStatus.Failed
+            self.job.finished = time.time()
+        super(JobHandler, self).fire_changed(current, msg)
+        self.inner.fire_changed(current, msg)
+
+    def _files(self):
+        return list(self.file_results) or None
+
+
+class JobRegistry(object):
+    """
+    Keeps the most recent max_jobs jobs in memory.
+    """
+
+    def __init__(self, max_jobs):
+        self.max_jobs = max(1, int(max_jobs))
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def remove(self, job):
+        with self._lock:
+            self._jobs.pop(job.id, None)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
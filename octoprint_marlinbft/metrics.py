@@ -0,0 +1,149 @@
+"""
+Marlin Binary File Transfer Metrics
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from bisect import bisect_left
+
+# seconds, from a block acknowledged on a fast usb link to one that needed a resend
+BLOCK_RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# seconds, from a small gcode file to a firmware image at a low baud rate
+TRANSFER_DURATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, lock):
+        self.name = name
+        self.documentation = documentation
+        self._lock = lock
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._add(amount, key)
+
+    def _add(self, amount, key=()):
+        # the caller holds the lock
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        for key, value in sorted(self._values.items()):
+            lines.append("%s%s %s" % (self.name, _labels(key), _number(value)))
+        if not self._values:
+            lines.append("%s 0" % self.name)
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, buckets, lock):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._lock = lock
+        # one count per bucket, and one for the observations above the largest
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        with self._lock:
+            self._observe(value)
+
+    def _observe(self, value):
+        # the caller holds the lock
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def expose(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %s' % (self.name, _number(bound), cumulative))
+        lines.append("%s_sum %s" % (self.name, _number(self._sum)))
+        lines.append("%s_count %s" % (self.name, self._count))
+        return lines
+
+
+class Metrics(object):
+    """
+    Counters and histograms of every transfer since OctoPrint started, shared by all ports
+    and exposed in the Prometheus text format. Recording takes one short lock, the only cost
+    on the per-block path next to waiting for the acknowledgement.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        lock = threading.Lock()
+        self.bytes_sent = Counter("marlinbft_bytes_sent_total",
+                                  "Payload bytes sent in acknowledged blocks.", lock)
+        self.blocks_sent = Counter("marlinbft_blocks_sent_total",
+                                   "Blocks sent and acknowledged.", lock)
+        self.retries = Counter("marlinbft_retries_total",
+                               "Blocks sent again after a timeout or a resend request.", lock)
+        self.timeouts = Counter("marlinbft_timeouts_total",
+                                "Packets that were not answered within the communication timeout.", lock)
+        self.fatal_errors = Counter("marlinbft_fatal_errors_total",
+                                    "Transfers the firmware gave up on with a fatal error.", lock)
+        self.transfers = Counter("marlinbft_transfers_total",
+                                 "Finished transfer jobs by outcome.", lock)
+        self.block_rtt = Histogram("marlinbft_block_rtt_seconds",
+                                   "Time from sending a block to its acknowledgement, resends included.",
+                                   BLOCK_RTT_BUCKETS, lock)
+        self.transfer_duration = Histogram("marlinbft_transfer_duration_seconds",
+                                           "Time from starting a transfer job to its outcome.",
+                                           TRANSFER_DURATION_BUCKETS, lock)
+        self._lock = lock
+
+    def block(self, size, rtt, retries):
+        """
+        Records an acknowledged block under a single lock.
+        """
+        with self._lock:
+            self.bytes_sent._add(size)
+            self.blocks_sent._add(1)
+            if retries:
+                self.retries._add(retries)
+            self.block_rtt._observe(rtt)
+
+    def transfer(self, outcome, duration):
+        self.transfers.inc(outcome=outcome)
+        self.transfer_duration.observe(duration)
+
+    def log(self, prefix, msg):
+        """
+        Counts the events binproto2 only reports through its logger.
+        """
+        if prefix == "binproto2" and msg in ("Packetloss detected", "Packet loss detected"):
+            self.timeouts.inc()
+
+    def expose(self):
+        with self._lock:
+            lines = []
+            for metric in (self.bytes_sent, self.blocks_sent, self.retries, self.timeouts, self.fatal_errors,
+                           self.transfers, self.block_rtt, self.transfer_duration):
+                lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in key)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
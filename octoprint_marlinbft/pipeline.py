@@ -0,0 +1,198 @@
+"""
+Marlin Binary File Transfer Pipelined Writes
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import struct
+from collections import deque
+
+from binproto2 import ConnectionLost, FatalError
+from time import sleep
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+PACKET_TOKEN = 0xB5AD
+# sync ids wrap at 256, an ok or rs can only be told apart from an old one within half of that
+MAX_WINDOW = 64
+
+
+def build_packet(sync, protocol_id, packet_type, data):
+    """
+    Frames data like Protocol._build_packet, with an explicit sync id.
+    """
+    header = struct.pack("<BBH", sync, ((protocol_id & 0xF) << 4) | (packet_type & 0xF), len(data))
+    header += struct.pack("<H", checksum(header))
+    packet = header
+    if data:
+        packet += bytes(data)
+        packet += struct.pack("<H", checksum(packet))
+    return struct.pack("<H", PACKET_TOKEN) + packet
+
+
+def checksum(buffer):
+    # 16 bit fletcher, as in binproto2
+    cs_low = cs_high = 0
+    for b in bytearray(buffer):
+        cs_low = (cs_low + b) % 255
+        cs_high = (cs_high + cs_low) % 255
+    return (cs_high << 8) | cs_low
+
+
+class _Packet(object):
+    __slots__ = ("sync", "data", "frame", "sent_pc", "transmissions")
+
+    def __init__(self, sync, data, frame):
+        self.sync = sync
+        self.data = data
+        self.frame = frame
+        self.sent_pc = 0
+        self.transmissions = 0
+
+
+class PipelinedWriter(object):
+    """
+    Keeps up to window write packets in flight instead of waiting for each acknowledgement,
+    so the throughput on a link with a long round trip is bound by its baud rate again.
+    Lost packets are recovered go-back-N: on a resend request or a timeout every packet from
+    the oldest unacknowledged one is sent again. Acknowledgements are cumulative, an ok or
+    rs for a packet acknowledges the packets before it too.
+
+    The firmware must advertise that it buffers a window of packets. The writer takes over
+    the protocol's sync id and response queue while it is in use and hands them back when
+    it is flushed. With a timer the oldest packet waits as long as the timer says instead
+    of the protocol's response timeout, and a timeout backs the timer off.
+    """
+
+    def __init__(self, protocol, window, protocol_id, packet_type, acknowledged, logger, timer=None):
+        self.protocol = protocol
+        self.window = max(1, min(int(window), MAX_WINDOW))
+        self.protocol_id = protocol_id
+        self.packet_type = packet_type
+        self.acknowledged = acknowledged
+        self.logger = logger
+        self.timer = timer
+        self.next_sync = protocol.sync
+        self.in_flight = deque()
+        self.rewinds = 0
+        self._rewound_at = None
+
+    def write(self, data):
+        packet = _Packet(self.next_sync, data, build_packet(self.next_sync, self.protocol_id, self.packet_type, data))
+        self.next_sync = (self.next_sync + 1) % 256
+        self.in_flight.append(packet)
+        self._transmit(packet)
+        while len(self.in_flight) >= self.window:
+            self._await_response()
+
+    def flush(self):
+        """
+        Waits until every packet is acknowledged and hands the protocol back.
+        """
+        try:
+            while self.in_flight:
+                self._await_response()
+            if self.rewinds:
+                # acknowledgements of packets that were sent twice may still be on their way
+                self._settle()
+        finally:
+            self.release()
+
+    def release(self):
+        # the firmware expects the oldest packet it has not acknowledged next
+        self.protocol.sync = self.in_flight[0].sync if self.in_flight else self.next_sync
+        self.protocol.responses.clear()
+
+    def _transmit(self, packet):
+        packet.sent_pc = perf_counter()
+        packet.transmissions += 1
+        frame = packet.frame
+        # the port does not block, write the rest of the frame if only a part of it fitted
+        while frame:
+            written = self.protocol.port.write(frame)
+            frame = frame[written or 0:]
+            if frame:
+                sleep(0.0001)
+
+    def _await_response(self):
+        deadline = perf_counter() + self._timeout() / 1000.0
+        give_up = perf_counter() + (self.timer.give_up if self.timer else self.protocol.response_timeout * 20) / 1000.0
+        responses = self.protocol.responses
+        while True:
+            while not responses:
+                sleep(0.00001)
+                now = perf_counter()
+                if now > deadline:
+                    if now > give_up or self.in_flight[0].transmissions > 20:
+                        raise ConnectionLost()
+                    self.logger.debug("Packet loss detected")
+                    self.protocol.errors += 1
+                    if self.timer:
+                        self.timer.backoff()
+                    self._rewind(force=True)
+                    deadline = perf_counter() + self._timeout() / 1000.0
+            token, data = responses.popleft()
+            if token == "fe":
+                raise FatalError()
+            if token not in ("ok", "rs"):
+                continue
+            try:
+                sync = int(data)
+            except ValueError:
+                continue
+            if token == "ok":
+                if self._acknowledge(sync, inclusive=True):
+                    return
+            else:
+                self._acknowledge(sync, inclusive=False)
+                if self.in_flight and self.in_flight[0].sync == sync:
+                    self.protocol.errors += 1
+                    self._rewind()
+                return
+
+    def _timeout(self):
+        return self.timer.timeout if self.timer else self.protocol.response_timeout
+
+    def _acknowledge(self, sync, inclusive):
+        """
+        Acknowledges the packets in flight before sync, and sync itself if inclusive. Returns
+        whether any were.
+        """
+        if not self.in_flight:
+            return False
+        distance = (sync - self.in_flight[0].sync) % 256
+        if distance >= len(self.in_flight):
+            # an answer to a packet that was already acknowledged
+            return False
+        count = distance + 1 if inclusive else distance
+        now = perf_counter()
+        for _ in range(count):
+            packet = self.in_flight.popleft()
+            self.acknowledged(packet.data, now - packet.sent_pc, packet.transmissions - 1)
+        if count:
+            self._rewound_at = None
+        return count > 0
+
+    def _rewind(self, force=False):
+        if not self.in_flight:
+            return
+        base = self.in_flight[0].sync
+        # every packet after a lost one asks for it again, go back once per loss
+        if base == self._rewound_at and not force:
+            return
+        self._rewound_at = base
+        self.rewinds += 1
+        for packet in self.in_flight:
+            self._transmit(packet)
+
+    def _settle(self, quiet=0.05):
+        responses = self.protocol.responses
+        quiet_since = perf_counter()
+        seen = len(responses)
+        while perf_counter() - quiet_since < quiet:
+            sleep(0.005)
+            if len(responses) != seen:
+                seen = len(responses)
+                quiet_since = perf_counter()
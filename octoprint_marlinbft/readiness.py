@@ -0,0 +1,65 @@
+"""
+Marlin Binary File Transfer Readiness Probe
+"""
+from __future__ import absolute_import, unicode_literals
+
+from time import sleep
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+
+class ReadinessProbe(object):
+    """
+    Waits for the firmware to answer on a freshly opened protocol instead of sleeping for a
+    fixed time. The probe gcode is written every interval until the firmware acknowledges
+    one. The line is then left to settle, and late acknowledgements of earlier probes are
+    discarded so they are not taken as the answer to the next command.
+    """
+
+    def __init__(self, protocol, logger, gcode="M105", interval_ms=250):
+        self.protocol = protocol
+        self.logger = logger
+        self.gcode = gcode
+        self.interval = interval_ms / 1000.0
+
+    def wait(self, timeout_ms):
+        """
+        Returns the seconds it took the firmware to answer, or None if it did not answer
+        within timeout_ms.
+        """
+        lines = []
+        listener = ([""], lambda data: lines.append(data[1]))
+        self.protocol.applications.append(listener)
+        start = perf_counter()
+        deadline = start + timeout_ms / 1000.0
+        ready = None
+        try:
+            while ready is None and perf_counter() < deadline:
+                self.protocol.send_ascii_no_wait(self.gcode)
+                next_probe = min(perf_counter() + self.interval, deadline)
+                while perf_counter() < next_probe:
+                    if self.protocol.responses:
+                        ready = perf_counter() - start
+                        break
+                    sleep(0.01)
+
+            if lines:
+                self.logger.info("Firmware output while waiting: %s" % lines[0])
+            if ready is not None:
+                self._settle(lines, deadline)
+        finally:
+            self.protocol.applications.remove(listener)
+            self.protocol.responses.clear()
+        return ready
+
+    def _settle(self, lines, deadline):
+        seen = (len(lines), len(self.protocol.responses))
+        quiet = perf_counter()
+        while perf_counter() - quiet < self.interval and perf_counter() < deadline + self.interval:
+            sleep(0.01)
+            if (len(lines), len(self.protocol.responses)) != seen:
+                seen = (len(lines), len(self.protocol.responses))
+                quiet = perf_counter()
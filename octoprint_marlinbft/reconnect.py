@@ -0,0 +1,124 @@
+"""
+Marlin Binary File Transfer Reconnect
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+
+from binproto2 import Protocol
+from serial import SerialException
+from octoprint_marlinbft.readiness import ReadinessProbe
+from octoprint_marlinbft.utils import Setting
+from time import sleep
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+
+class Reconnector(object):
+    """
+    Hands the serial port back to OctoPrint's printer connection once a transfer has
+    released it. A board that is reset after the transfer (M997) drops its device node and
+    brings it back when it has rebooted, so the node is watched before the firmware is
+    probed for readiness. wait_before_reconnect_ms bounds the whole wait.
+    """
+
+    connect_timeout = 30
+    reset_timeout = 3
+    poll_interval = 0.25
+
+    def __init__(self, printer, scheduler, logger):
+        self.printer = printer
+        self.scheduler = scheduler
+        self.logger = logger
+
+    def reconnect(self, port, baudrate, printer_profile, settings, bft_logger, expect_reset=False):
+        """
+        Returns the seconds spent in each step, or None if the reconnect was skipped.
+        """
+        if self.scheduler and self.scheduler.queued(port):
+            bft_logger.info("Not reconnecting the printer, another transfer is queued on %s" % port)
+            return None
+
+        wait = settings.get_int(Setting.WaitBeforeReconnect) / 1000.0
+        start = perf_counter()
+        deadline = start + wait
+        timings = dict()
+
+        step = perf_counter()
+        if expect_reset and self._watches(port):
+            if self._poll(lambda: not os.path.exists(port), min(deadline, step + self.reset_timeout)):
+                bft_logger.info("Device %s went away" % port)
+        timings["release"] = perf_counter() - step
+
+        step = perf_counter()
+        if self._watches(port) and not self._poll(lambda: os.path.exists(port), max(deadline, step + self.poll_interval)):
+            bft_logger.warn("Device %s did not come back within %sms" % (port, int(wait * 1000)))
+        timings["device"] = perf_counter() - step
+
+        step = perf_counter()
+        if settings.get_boolean(Setting.ReadinessProbe):
+            if self._probe(port, baudrate, settings, bft_logger, deadline) is None:
+                bft_logger.warn("Firmware on %s did not answer, reconnecting anyway" % port)
+        elif deadline > perf_counter():
+            sleep(deadline - perf_counter())
+        timings["ready"] = perf_counter() - step
+
+        step = perf_counter()
+        bft_logger.info("Reconnecting the printer on %s at %s baud" % (port, baudrate))
+        self.printer.connect(port=port, baudrate=baudrate, profile=printer_profile)
+        if not self._poll(self.printer.is_operational, step + self.connect_timeout):
+            bft_logger.warn("Printer is not operational after %ss" % self.connect_timeout)
+        timings["connect"] = perf_counter() - step
+
+        timings["total"] = perf_counter() - start
+        bft_logger.info("Reconnected in %.2fs (release %.2fs, device %.2fs, ready %.2fs, connect %.2fs)" % (
+            timings["total"], timings["release"], timings["device"], timings["ready"], timings["connect"]))
+        return timings
+
+    def _probe(self, port, baudrate, settings, bft_logger, deadline):
+        """
+        Opens port until it can be opened and asks the firmware whether it is ready. At least
+        one probe is made even if the deadline has already passed.
+        """
+        while True:
+            remaining = max(deadline - perf_counter(), 0)
+            protocol = None
+            try:
+                protocol = Protocol(port, baudrate, settings.get_int(Setting.BlockSize), settings.get_int(Setting.CommTimeout),
+                                    bft_logger.copy(prefix="binproto2"))
+                probe = ReadinessProbe(protocol, bft_logger.copy(prefix="readiness"),
+                                       settings.get(Setting.ReadinessProbeGcode),
+                                       settings.get_int(Setting.ReadinessInterval))
+                return probe.wait(max(remaining * 1000, settings.get_int(Setting.ReadinessInterval)))
+            except SerialException as exc:
+                self.logger.info("Could not open %s yet: %s" % (port, exc))
+                if perf_counter() >= deadline:
+                    return None
+                sleep(self.poll_interval)
+            finally:
+                if protocol:
+                    self._shutdown(protocol)
+
+    def _shutdown(self, protocol):
+        # the receive worker blocks in readline for up to a second, wake it up so the port
+        # is free for OctoPrint right away
+        protocol.connected = False
+        cancel_read = getattr(protocol.port, "cancel_read", None)
+        if cancel_read:
+            cancel_read()
+        protocol.shutdown()
+
+    def _poll(self, condition, until):
+        while not condition():
+            if perf_counter() >= until:
+                return False
+            sleep(self.poll_interval)
+        return True
+
+    @staticmethod
+    def _watches(port):
+        # only device nodes can be watched, not COM ports or virtual connections
+        return os.path.isabs(port)
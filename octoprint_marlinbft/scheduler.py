@@ -0,0 +1,92 @@
+"""
+Marlin Binary File Transfer Scheduler
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from collections import deque
+
+
+class PortBusyError(Exception):
+    def __init__(self, port):
+        super(PortBusyError, self).__init__("Port %s is busy" % port)
+        self.port = port
+
+
+class TransferScheduler(object):
+    """
+    Runs transfer jobs with one queue per serial port. Jobs for the same port run one after
+    the other, jobs for different ports run in parallel on a pool of at most max_workers
+    threads. max_workers is a callable returning the limit; it is read on every submit, so
+    a changed setting applies to the next job. Threads are started as they are needed and
+    end once no port has a job waiting.
+    """
+
+    def __init__(self, logger, max_workers):
+        self.logger = logger
+        self.max_workers = max_workers
+        self._queues = {}
+        self._ready = deque()
+        self._executing = set()
+        self._workers = 0
+        self._lock = threading.Lock()
+
+    def busy(self, port):
+        with self._lock:
+            return port in self._queues
+
+    def queued(self, port):
+        """
+        Returns the number of jobs waiting for port, not counting the one running on it.
+        """
+        with self._lock:
+            return len(self._queues.get(port, ()))
+
+    def submit(self, port, target, queue=True):
+        """
+        Schedules the callable target on port and returns the number of jobs ahead of it.
+        Raises PortBusyError if the port is busy and queue is False.
+        """
+        limit = max(1, int(self.max_workers()))
+        with self._lock:
+            if port in self._queues and not queue:
+                raise PortBusyError(port)
+
+            jobs = self._queues.setdefault(port, deque())
+            jobs.append(target)
+            position = len(jobs) - 1 + (1 if port in self._executing else 0)
+
+            # a port is ready when it has jobs and none of them is running
+            if len(jobs) == 1 and port not in self._executing:
+                self._ready.append(port)
+            if self._ready and self._workers < limit:
+                self._workers += 1
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+
+        self.logger.info("Scheduled transfer on %s (%s ahead)" % (port, position))
+        return position
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._ready:
+                    self._workers -= 1
+                    return
+                port = self._ready.popleft()
+                target = self._queues[port].popleft()
+                self._executing.add(port)
+
+            try:
+                target()
+            except Exception:
+                self.logger.exception("Transfer job on %s raised" % port)
+
+            with self._lock:
+                self._executing.discard(port)
+                if self._queues[port]:
+                    # behind the other ports that are waiting, so no port keeps a worker
+                    self._ready.append(port)
+                else:
+                    del self._queues[port]
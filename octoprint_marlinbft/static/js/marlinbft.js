@@ -5,6 +5,46 @@
  * License: MIT
  */
 $(function() {
+    // the most recent capacity lines, oldest first. a line that only differs from the one
+    // before it in its numbers, like a retry count, replaces it and counts as a repeat
+    function TerminalBuffer(capacity) {
+        var self = this;
+
+        self.capacity = capacity;
+        self.lines    = new Array(capacity);
+        self.start    = 0;
+        self.length   = 0;
+
+        self.push = function(text) {
+            var key = String(text).replace(/\d+/g, "#");
+            var last = self.length ? self.get(self.length - 1) : undefined;
+            if (last && last.key == key) {
+                last.text = text;
+                last.count++;
+                return;
+            }
+
+            var line = {text: text, key: key, count: 1};
+            if (self.length < self.capacity) {
+                self.lines[(self.start + self.length) % self.capacity] = line;
+                self.length++;
+            } else {
+                self.lines[self.start] = line;
+                self.start = (self.start + 1) % self.capacity;
+            }
+        }
+
+        self.get = function(index) {
+            return self.lines[(self.start + index) % self.capacity];
+        }
+
+        self.clear = function() {
+            self.lines  = new Array(self.capacity);
+            self.start  = 0;
+            self.length = 0;
+        }
+    }
+
     function MarlinbftViewModel(parameters) {
         var self = this;
         var pluginid = "marlinbft";
@@ -15,9 +55,16 @@ $(function() {
         self.access      = parameters[3];
         self.settings    = undefined;
 
-        self.output           = ko.observableArray();
+        self.output           = new TerminalBuffer(1000);
         self.activeHelpText   = ko.observable(undefined);
         self.isSending        = ko.observable(undefined);
+        self.batchMode        = ko.observable(false);
+        self.progress         = ko.observable(undefined);
+        self.batchPaths       = [];
+        self.batchUploading   = false;
+        self.batchConfirmed   = false;
+        self.batchHeld        = [];
+        self.closeOnInactive  = false;
 
         self.postGcode        = ko.pureComputed({
             read: function() {
@@ -30,6 +77,25 @@ $(function() {
             },
         });
 
+        self.progressPercent = ko.pureComputed(() => self.progress() && self.progress().total ? self.progress().sent / self.progress().total * 100 : 0);
+
+        self.progressText = ko.pureComputed(() => {
+            var p = self.progress();
+            if (!p) {
+                return "";
+            }
+            // a streamed upload without a Content-Length has no known total
+            var text = p.file + ": " + (p.sent / 1024).toFixed(1) + (p.total ? " / " + (p.total / 1024).toFixed(1) : "") + " KiB"
+                + " @ " + (p.throughput / 1024).toFixed(2) + " KiB/s";
+            if (p.eta !== null) {
+                text += ", " + Math.ceil(p.eta) + "s left";
+            }
+            if (p.retries) {
+                text += ", " + p.retries + " retries";
+            }
+            return text;
+        });
+
         self.uploadAccept = ko.pureComputed(() => self.settings.accept_extensions().split(",").map(x => "." + x).join(","));
 
         self.canSend = ko.pureComputed(() => self.connection.isOperational() && self.settings.has_capability());
@@ -37,12 +103,18 @@ $(function() {
         self.uploadButton    = $("#upload-binary");
         self.marlinbftDialog = $("#marlinbft-dialog");
         self.bftTerminal     = $("#bft-terminal");
-        
+        self.terminalSpacer  = $("#bft-terminal-spacer");
+        self.terminalRows    = $("#bft-terminal-rows");
+        self.terminalFrame   = undefined;
+        self.lineHeight      = undefined;
+        self.followOutput    = true;
+
         self.octoTerminal    = $("#terminal-output");
 
         self.onBeforeBinding = function() {
             console.log("BeforeBinding: MarlinBFT");
             self.settings = self.settings_vm.settings.plugins.marlinbft;
+            self.output = new TerminalBuffer(Math.max(1, parseInt(self.settings.terminal_max_lines(), 10) || 1000));
             self._updateTerminal(false);
 
             var helpTextElements = $("[data-helptext]");
@@ -63,6 +135,10 @@ $(function() {
             self._setFileUpload();
             self.clearHelpText();
             self.isSending(false);
+
+            self.bftTerminal.on("scroll", self._handleTerminalScroll);
+            self.isSending.subscribe(self._showLatest);
+            self.marlinbftDialog.on("shown", self._showLatest);
         }
 
         self._setFileUpload = function() {
@@ -74,14 +150,31 @@ $(function() {
                 add:  self._handleUploadAdd,
                 done: self._handleUploadDone,
                 fail: self._handleUploadFail,
+                stop: self._handleUploadStop,
                 progress: self._handleUploadProgress
             });
         }
 
         self._handleUploadAdd = function(e, data) {
+            data.formData = { path: self.settings.upload_folder() };
+
+            if (self.batchMode() && self.batchUploading) {
+                // the rest of a batch selection, held until the first file's confirmation resolves
+                self._updateTerminal("Queued " + data.files[0].name + " for upload");
+                if (self.batchConfirmed) {
+                    data.submit();
+                } else {
+                    self.batchHeld.push(data);
+                }
+                return;
+            }
+
             self._updateTerminal(false);
             self.isSending(true);
-            data.formData = { path: self.settings.upload_folder() };
+            self.batchPaths = [];
+            self.batchUploading = self.batchMode();
+            self.batchConfirmed = false;
+            self.batchHeld = [];
             
             console.log("Upload phase: add file to queue");
             console.log(data);
@@ -104,6 +197,7 @@ $(function() {
                         switch (idx) {
                             case 0:
                                 console.log("Cancelling");
+                                self._cancelUpload();
                                 return false;
                             case 1:
                                 console.log("Continuing");
@@ -111,44 +205,132 @@ $(function() {
                                 break;
                         }
 
-                        self._startUpload(data);
+                        self._confirmUpload(data);
                     },
                     onclose: function() {
+                        // closed without choosing counts as cancel
+                        if (!self.batchConfirmed) {
+                            self._cancelUpload();
+                        }
                         return false;
                     }
                 });
             } else {
-                self._startUpload(data);
+                self._confirmUpload(data);
             }
         }
 
+        self._confirmUpload = function(data) {
+            self.batchConfirmed = true;
+            self._startUpload(data);
+
+            var held = self.batchHeld;
+            self.batchHeld = [];
+            held.forEach(item => item.submit());
+        }
+
+        self._cancelUpload = function() {
+            // files of the batch that were held back are never uploaded
+            self.batchHeld.forEach(item => self._updateTerminal("Skipped " + item.files[0].name));
+            self.batchHeld = [];
+            self.batchPaths = [];
+            self.batchUploading = false;
+            self.batchConfirmed = false;
+            self.isSending(false);
+        }
+
         self._startUpload = function(data) {
+            if (self.settings.stream_upload() && !self.batchMode()) {
+                self._startStreamUpload(data);
+                return;
+            }
+
             console.log("Upload phase: start upload to server");
             OctoPrint.simpleApiCommand(pluginid, "change_phase", {"curr": "Upload"});
             data.submit();
         }
 
+        self._startStreamUpload = function(data) {
+            console.log("Upload phase: stream upload to Marlin");
+            OctoPrint.connection.getSettings()
+                .then(settings => {
+                    self.currentPrinter = settings.current;
+                    OctoPrint.connection.disconnect().then(_ => {
+                        var params = $.param({
+                            "port": self.currentPrinter.port,
+                            "baudrate": self.currentPrinter.baudrate,
+                            "printer_profile": self.currentPrinter.printerProfile,
+                            "handler_type": "dialog",
+                            "filename": data.files[0].name
+                        });
+
+                        data.url = BASEURL + "plugin/" + pluginid + "/stream?" + params;
+                        data.multipart = false;
+                        data.streaming = true;
+                        self._updateTerminal("Streaming upload to Marlin");
+                        data.submit();
+                    });
+                });
+        }
+
         self._handleUploadDone = function(e, data) {
             console.log("Upload phase: done");
             console.log(data);
+
+            if (data.streaming) {
+                self._updateTerminal("Upload streamed to Marlin as " + data.result.remote_name);
+                return;
+            }
+
             self._updateTerminal("Upload to server done");
+
+            if (self.batchMode()) {
+                self.batchPaths.push(data.result.files.local.path);
+                return;
+            }
+
             self._updateTerminal("Starting transfer to Marlin");
+            self._startTransfer("start_transfer", {"local_path": data.result.files.local.path});
+        }
+
+        self._handleUploadStop = function(e) {
+            if (!self.batchUploading) {
+                return;
+            }
+            self.batchUploading = false;
 
+            if (self.batchPaths.length == 0) {
+                OctoPrint.simpleApiCommand(pluginid, "change_phase", {"curr": "Inactive"});
+                return;
+            }
+
+            self._updateTerminal("Starting batch transfer of " + self.batchPaths.length + " files to Marlin");
+            self._startTransfer("start_batch_transfer", {"local_paths": self.batchPaths});
+        }
+
+        self.syncFolder = function() {
+            self._updateTerminal(false);
+            self.isSending(true);
+            self._updateTerminal("Syncing upload folder '" + self.settings.upload_folder() + "' to Marlin");
+            self._startTransfer("sync_folder", {});
+        }
+
+        self._startTransfer = function(command, files) {
             OctoPrint.connection.getSettings()
                 .then(settings => {
                     self.currentPrinter = settings.current;
                     OctoPrint.connection.disconnect().then(_ => {
-                        params = {
-                            "local_path": data.result.files.local.path,
+                        params = Object.assign({
                             "port": self.currentPrinter.port,
                             "baudrate": self.currentPrinter.baudrate,
+                            "printer_profile": self.currentPrinter.printerProfile,
                             "handler_type": "dialog"
-                        };
+                        }, files);
 
                         console.log("Start transfer");
                         console.log(params);
 
-                        OctoPrint.simpleApiCommand(pluginid, "start_transfer", params)
+                        OctoPrint.simpleApiCommand(pluginid, command, params)
                             .always(resp => {
                                 console.log(resp);
                                 self._updateTerminal(resp.statusText)
@@ -161,7 +343,9 @@ $(function() {
             console.log("Upload phase: fail");
             console.log(data);
             self._updateTerminal("Upload to server failed");
-            OctoPrint.simpleApiCommand(pluginid, "change_phase", {"curr": "Inactive"});
+            if (!self.batchMode()) {
+                OctoPrint.simpleApiCommand(pluginid, "change_phase", {"curr": "Inactive"});
+            }
         }
 
         self._handleUploadProgress = function (e, data) {
@@ -170,30 +354,116 @@ $(function() {
 
         self.onDataUpdaterPluginMessage = function(plugin, message) {
             if (plugin == pluginid) {
-                self._updateTerminal(message);
+                // messages arrive coalesced as a list of lines
+                [].concat(message).forEach(line => self._updateTerminal(line));
             }
         }
 
         self._updateTerminal = function(msg) {
             if (msg) {
                 self.output.push(msg);
-                self.bftTerminal.scrollTop(self.bftTerminal[0].scrollHeight);
             } else {
-                self.output.removeAll();
+                self.output.clear();
+                self.followOutput = true;
+            }
+            self._scheduleRender();
+        }
+
+        self._showLatest = function() {
+            self.followOutput = true;
+            self._scheduleRender();
+        }
+
+        self._handleTerminalScroll = function() {
+            var terminal = self.bftTerminal[0];
+            // keep following the output unless the user scrolled up
+            self.followOutput = terminal.scrollTop + terminal.clientHeight >= terminal.scrollHeight - self._measureLineHeight();
+            self._scheduleRender();
+        }
+
+        // lines arriving within one animation frame are drawn together, and only the lines
+        // scrolled into view are in the DOM
+        self._scheduleRender = function() {
+            if (self.terminalFrame === undefined) {
+                self.terminalFrame = window.requestAnimationFrame(self._renderTerminal);
+            }
+        }
+
+        self._renderTerminal = function() {
+            self.terminalFrame = undefined;
+            var terminal = self.bftTerminal[0];
+            if (!terminal) {
+                return;
+            }
+
+            var lineHeight = self._measureLineHeight();
+            var height = terminal.clientHeight || 110;
+            self.terminalSpacer.css("height", self.output.length * lineHeight + "px");
+            if (self.followOutput) {
+                terminal.scrollTop = terminal.scrollHeight;
+            }
+
+            var overscan = 5;
+            var first = Math.max(0, Math.floor(terminal.scrollTop / lineHeight) - overscan);
+            var last = Math.min(self.output.length, Math.ceil((terminal.scrollTop + height) / lineHeight) + overscan);
+
+            var rows = document.createDocumentFragment();
+            for (var i = first; i < last; i++) {
+                var line = self.output.get(i);
+                var row = document.createElement("span");
+                row.style.display = "block";
+                row.style.whiteSpace = "nowrap";
+                row.style.height = lineHeight + "px";
+                row.textContent = line.text;
+                if (line.count > 1) {
+                    var repeats = document.createElement("span");
+                    repeats.className = "muted";
+                    repeats.textContent = " (\u00d7" + line.count + ")";
+                    row.appendChild(repeats);
+                }
+                rows.appendChild(row);
+            }
+            self.terminalRows.css("transform", "translateY(" + first * lineHeight + "px)");
+            self.terminalRows.empty().append(rows);
+        }
+
+        self._measureLineHeight = function() {
+            if (!self.lineHeight) {
+                var probe = $("<span>&nbsp;</span>").css({display: "block", visibility: "hidden"}).appendTo(self.terminalRows);
+                self.lineHeight = probe[0].offsetHeight || undefined;
+                probe.remove();
             }
+            return self.lineHeight || 18;
+        }
+
+        self.downloadLog = function() {
+            OctoPrint.get("plugin/" + pluginid + "/log", {dataType: "text"})
+                .done(text => {
+                    var link = document.createElement("a");
+                    link.href = URL.createObjectURL(new Blob([text], {type: "text/plain"}));
+                    link.download = "marlinbft.log";
+                    document.body.appendChild(link);
+                    link.click();
+                    document.body.removeChild(link);
+                    URL.revokeObjectURL(link.href);
+                });
+        }
+
+        self.onEventplugin_marlinbft_transfer_progress = function(payload) {
+            self.progress(payload);
         }
 
         self.onEventplugin_marlinbft_phase_changed = function(payload) {
             console.log(payload.prev + " ==> " + payload.curr);
             switch (payload.curr) {
+                case "PreConnect":
+                    self.closeOnInactive = false;
+                    self.progress(undefined);
+                    break;
                 case "CompleteOK":
                     if (self.settings.reconnect()) {
-                        var to = self.settings.wait_before_reconnect_ms();
-                        self._updateTerminal("Printer will reconnect in " + to/1000 + "s...");
-                        window.setTimeout(
-                            self._reconnectPrinter,
-                            to
-                        );
+                        self._updateTerminal("Printer will reconnect once it is ready...");
+                        self.closeOnInactive = true;
                     }
                     if (["OnlyOnSuccess", "Always"].includes(self.settings.delete_upload())) {
                         self._cleanupFile(payload.msg);
@@ -204,17 +474,20 @@ $(function() {
                         self._cleanupFile(payload.msg);
                     }
                     break;
+                case "Inactive":
+                    if (self.closeOnInactive) {
+                        self.closeOnInactive = false;
+                        self.close();
+                    }
+                    break;
             }
         }
 
-        self._reconnectPrinter = function() {
-            OctoPrint.connection.connect(self.currentPrinter);
-            self.close();
-        }
-
         self._cleanupFile = function(path) {
-            console.log("deleting file: " + path);
-            OctoPrint.files.delete("local", path);
+            [].concat(path).filter(p => p).forEach(function(p) {
+                console.log("deleting file: " + p);
+                OctoPrint.files.delete("local", p);
+            });
         }
 
         self.show = function() {
@@ -238,6 +511,10 @@ $(function() {
             self.settings_vm.saveData();
         }
 
+        self.toggleBatchMode = function() {
+            self.batchMode(!self.batchMode());
+        }
+
         self.toggleReconnect = function() {
             self.settings.reconnect(
                 !self.settings.reconnect()
@@ -263,9 +540,62 @@ $(function() {
         }
     }
 
+    function MarlinbftHistoryViewModel(parameters) {
+        var self = this;
+        var pluginid = "marlinbft";
+        var days = 30;
+
+        self.printers = ko.observableArray();
+        self.loading  = ko.observable(false);
+
+        self.onSettingsShown = function() {
+            self.refresh();
+        }
+
+        self.refresh = function() {
+            self.loading(true);
+            OctoPrint.getWithQuery("api/plugin/" + pluginid, {stats: 1, days: days})
+                .done(response => self.printers(response.printers))
+                .always(() => self.loading(false));
+        }
+
+        self.formatRate = function(rate) {
+            return (rate * 100).toFixed(1) + "%";
+        }
+
+        self.formatThroughput = function(throughput) {
+            return throughput ? (throughput / 1024).toFixed(2) : "-";
+        }
+
+        // one bar per day, its height the throughput relative to the best day, red if a transfer failed
+        self.trend = function(printer) {
+            var best = Math.max.apply(null, printer.days.map(day => day.throughput || 0)) || 1;
+            var first = Math.floor(Date.now() / 86400000) - days + 1;
+            var byDay = {};
+            printer.days.forEach(day => byDay[day.day / 86400] = day);
+
+            var bars = [];
+            for (var i = first; i < first + days; i++) {
+                var day = byDay[i];
+                bars.push({
+                    height: day ? Math.max(2, Math.round((day.throughput || 0) / best * 16)) : 0,
+                    failed: day ? day.failures > 0 : false,
+                    title: day ? new Date(day.day * 1000).toLocaleDateString() + ": " + day.transfers + " transfers, "
+                                 + day.failures + " failed, " + self.formatThroughput(day.throughput) + " KiB/s" : ""
+                });
+            }
+            return bars;
+        }
+    }
+
     OCTOPRINT_VIEWMODELS.push({
         construct: MarlinbftViewModel,
         dependencies: ["settingsViewModel", "loginStateViewModel", "connectionViewModel", "accessViewModel"],
         elements: ["#marlinbft-dialog", "#navbar_plugin_marlinbft"]
     });
+
+    OCTOPRINT_VIEWMODELS.push({
+        construct: MarlinbftHistoryViewModel,
+        elements: ["#marlinbft-history"]
+    });
 });
@@ -0,0 +1,145 @@
+"""
+Marlin Binary File Transfer Streaming Upload
+"""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+from tornado.ioloop import IOLoop
+
+from octoprint_marlinbft.scheduler import PortBusyError
+
+
+class StreamAborted(Exception):
+    pass
+
+
+class StreamSource(object):
+    """
+    A bounded buffer between an upload and the transfer that consumes it. put blocks while
+    more than max_bytes are waiting, which holds back the upload when the serial link is the
+    slower side. Iterating yields the chunks in order until the upload is closed.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max(1, int(max_bytes))
+        self.received = 0
+        self._chunks = deque()
+        self._buffered = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def put(self, chunk):
+        with self._cond:
+            while self._buffered >= self.max_bytes and not self._error:
+                self._cond.wait()
+            if self._error:
+                raise StreamAborted(self._error)
+            self._chunks.append(chunk)
+            self._buffered += len(chunk)
+            self.received += len(chunk)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self, reason):
+        """
+        Ends the stream from either side: the transfer fails on its next read and the upload
+        on its next put.
+        """
+        with self._cond:
+            self._error = reason
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not self._chunks and not self._closed and not self._error:
+                    self._cond.wait()
+                if self._error:
+                    raise StreamAborted(self._error)
+                if not self._chunks:
+                    return
+                chunk = self._chunks.popleft()
+                self._buffered -= len(chunk)
+                self._cond.notify_all()
+            yield chunk
+
+
+@tornado.web.stream_request_body
+class StreamTransferHandler(tornado.web.RequestHandler):
+    """
+    Accepts a file as the raw body of a POST and feeds it to a transfer while it is
+    uploaded. The transfer parameters are passed as query arguments. start is called with
+    those arguments and the expected size and returns the StreamSource and the job. Each
+    upload waits for room in its buffer on a thread of its own, so a slow serial link does
+    not hold up the io loop's shared executor.
+    """
+
+    required = ("filename", "port", "baudrate")
+
+    def initialize(self, start, access_validation=None):
+        self._start = start
+        self._access_validation = access_validation
+        self.source = None
+        self.job = None
+        self._executor = None
+
+    def prepare(self):
+        if self._access_validation:
+            self._access_validation(self.request)
+
+        args = dict((key, self.get_query_argument(key)) for key in self.request.query_arguments)
+        missing = [key for key in self.required if not args.get(key)]
+        if missing:
+            raise tornado.web.HTTPError(400, "Missing %s" % ", ".join(missing))
+
+        total = int(self.request.headers.get("Content-Length", 0)) or None
+        try:
+            self.source, self.job = self._start(args, total)
+        except PortBusyError as exc:
+            raise tornado.web.HTTPError(409, str(exc))
+
+    def data_received(self, chunk):
+        # put blocks while the buffer is full, so wait for it off the io loop. tornado
+        # does not read more of the body until the returned future is done
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return IOLoop.current().run_in_executor(self._executor, self._put, chunk)
+
+    def _put(self, chunk):
+        try:
+            self.source.put(chunk)
+        except StreamAborted:
+            # the transfer failed, drop the rest of the upload
+            pass
+
+    def post(self):
+        self.source.close()
+        self.set_header("Content-Type", "application/json")
+        self.write(dict(job_id=self.job.id, remote_name=self.job.remote_names[0], received=self.source.received))
+
+    def on_connection_close(self):
+        if self.source and not self.source.closed:
+            self.source.abort("Upload was interrupted")
+        self._shutdown_executor()
+
+    def on_finish(self):
+        self._shutdown_executor()
+
+    def _shutdown_executor(self):
+        if self._executor:
+            # an aborted source wakes a put that is still waiting
+            self._executor.shutdown(wait=False)
+            self._executor = None
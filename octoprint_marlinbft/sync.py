@@ -0,0 +1,127 @@
+"""
+Marlin Binary File Transfer Folder Sync
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+# a protocol reply is the whole first word of a line, a file name may only start with one
+_reply = re.compile(r"^(ok|rs|ss|fe)(\s|$)")
+
+
+def list_remote_files(protocol):
+    """
+    Asks the firmware for the files on its SD card with M20. Must be called before the protocol
+    switches to binary mode. Returns a dict of upper case file name to size (None if the firmware
+    does not report sizes), or None if the firmware did not answer with a file list.
+    """
+    lines = []
+    applications = list(protocol.applications)
+
+    def collect(data):
+        # the protocol takes any line starting with one of its tokens for a reply, a listed
+        # okay.gco too, so this goes first and only passes whole word replies on
+        line = data[1]
+        if not _reply.match(line):
+            lines.append(line)
+            return
+        for tokens, callback in applications:
+            for token in tokens:
+                if line.startswith(token):
+                    callback((token, line[len(token):]))
+                    return
+
+    collector = ([""], collect)
+    protocol.applications.insert(0, collector)
+    try:
+        protocol.send_ascii("M20")
+    finally:
+        protocol.applications.remove(collector)
+
+    if "Begin file list" not in lines or "End file list" not in lines:
+        return None
+
+    files = {}
+    for line in lines[lines.index("Begin file list") + 1:lines.index("End file list")]:
+        parts = line.split()
+        if not parts:
+            continue
+        files[parts[0].upper()] = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+    return files
+
+
+class SyncManifest(object):
+    """
+    Content hashes of the files pushed to each printer, stored as json. Hashes of local files
+    are cached by size and modification time so unchanged files are not read again.
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._printers = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._printers = json.load(f)
+            except (IOError, ValueError) as exc:
+                self.logger.warn("Could not read sync manifest %s: %s" % (self.path, exc))
+
+    def digest(self, disk_path):
+        stat = os.stat(disk_path)
+        cached = self._hashes.get(disk_path)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime):
+            return cached[1]
+
+        sha = hashlib.sha256()
+        with open(disk_path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                sha.update(chunk)
+        self._hashes[disk_path] = ((stat.st_size, stat.st_mtime), sha.hexdigest())
+        return sha.hexdigest()
+
+    def select(self, printer, fileInfos, remote_files=None):
+        """
+        Returns the files that are new or changed since they were last pushed to printer, or
+        that are missing from (or have a different size in) remote_files when it is given.
+        """
+        with self._lock:
+            entries = dict(self._printers.get(printer, {}))
+
+        selected = []
+        for fileInfo in fileInfos:
+            entry = entries.get(fileInfo.remote_basename)
+            if not entry or entry["hash"] != self.digest(fileInfo.local_diskpath):
+                selected.append(fileInfo)
+            elif remote_files is not None and remote_files.get(fileInfo.remote_basename.upper(), -1) not in (None, entry["size"]):
+                self.logger.info("%s is missing or differs on the printer" % fileInfo.remote_basename)
+                selected.append(fileInfo)
+        return selected
+
+    def record(self, printer, fileInfo):
+        entry = dict(
+            hash       = self.digest(fileInfo.local_diskpath),
+            size       = os.path.getsize(fileInfo.local_diskpath),
+            local_path = fileInfo.local_path,
+            time       = time.time(),
+        )
+        with self._lock:
+            self._printers.setdefault(printer, {})[fileInfo.remote_basename] = entry
+            self._save()
+
+    def _save(self):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self._printers, f, indent=2)
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+        except (IOError, OSError) as exc:
+            self.logger.warn("Could not write sync manifest %s: %s" % (self.path, exc))
@@ -0,0 +1,131 @@
+"""
+Marlin Binary File Transfer Timeline
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import cProfile
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    from time import perf_counter
+except ImportError:
+    # Python < 3.3
+    from backports.time_perf_counter import perf_counter
+
+# cpu time of the calling thread, Python >= 3.7
+_thread_time = getattr(time, "thread_time", None)
+
+
+class Timeline(object):
+    """
+    Where the time of a job went: the phases it passed through and the steps within them,
+    in seconds since the job started. A step that runs many times, like compressing a chunk
+    or writing the blocks of one, is added up into one entry with a count. Steps record the
+    cpu time of the transfer thread too where Python can tell it, so a step whose cpu time
+    is close to its elapsed time was bound by the host, one with little cpu time was waiting
+    for the link or the firmware.
+    """
+
+    def __init__(self):
+        self.origin = perf_counter()
+        self.phases = []
+        self.steps = []
+        self._totals = {}
+
+    def phase(self, name):
+        now = self._now()
+        if self.phases and self.phases[-1]["elapsed"] is None:
+            self.phases[-1]["elapsed"] = now - self.phases[-1]["start"]
+        self.phases.append(dict(name=name, start=now, elapsed=None))
+
+    @contextmanager
+    def step(self, name, **info):
+        start = self._now()
+        cpu = _thread_time() if _thread_time else None
+        try:
+            yield
+        finally:
+            entry = dict(info, name=name, phase=self._phase(), start=start, elapsed=self._now() - start)
+            if cpu is not None:
+                entry["cpu"] = _thread_time() - cpu
+            self.steps.append(entry)
+
+    def add(self, name, start_pc, elapsed):
+        """
+        Adds elapsed seconds, measured from start_pc, to the step name.
+        """
+        key = (name, self._phase())
+        entry = self._totals.get(key)
+        if entry is None:
+            entry = self._totals[key] = dict(name=name, phase=key[1], start=start_pc - self.origin, elapsed=0.0, count=0)
+            self.steps.append(entry)
+        entry["elapsed"] += elapsed
+        entry["count"] += 1
+
+    def to_dict(self):
+        phases = [dict(phase) for phase in self.phases]
+        if phases and phases[-1]["elapsed"] is None:
+            phases[-1]["elapsed"] = self._now() - phases[-1]["start"]
+        return dict(
+            total  = self._now(),
+            phases = phases,
+            steps  = sorted((dict(step) for step in self.steps), key=lambda step: step["start"]),
+        )
+
+    def _phase(self):
+        return self.phases[-1]["name"] if self.phases else None
+
+    def _now(self):
+        return perf_counter() - self.origin
+
+
+class Profiler(object):
+    """
+    Profiles the calling thread with cProfile and saves the statistics to folder, for
+    python -m pstats or a viewer like snakeviz. Only the newest keep files are kept.
+    """
+
+    keep = 20
+
+    def __init__(self, folder, logger):
+        self.folder = folder
+        self.logger = logger
+        self.profile = None
+
+    def start(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as exc:
+            # one profiler per interpreter since Python 3.12
+            self.logger.warn("Not profiling the transfer: %s" % exc)
+            return
+        self.profile = profile
+
+    def stop(self, name):
+        """
+        Saves the profile as name.prof and returns its path, or None.
+        """
+        if not self.profile:
+            return None
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+        try:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            path = os.path.join(self.folder, "%s.prof" % name)
+            profile.dump_stats(path)
+            self._prune()
+        except (IOError, OSError) as exc:
+            self.logger.warn("Could not save the transfer profile to %s: %s" % (self.folder, exc))
+            return None
+        self.logger.info("Saved the transfer profile to %s" % path)
+        return path
+
+    def _prune(self):
+        profiles = sorted((os.path.join(self.folder, name) for name in os.listdir(self.folder) if name.endswith(".prof")),
+                          key=os.path.getmtime)
+        for path in profiles[:-self.keep]:
+            os.remove(path)
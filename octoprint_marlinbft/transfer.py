@@ -1,84 +1,545 @@
-from binproto2 import FileTransferProtocol, Protocol, FatalError
-from octoprint_marlinbft.utils import BftLogger, DeleteUpload, Setting, Phase, SettingsResolver
-from time import sleep
+import os
+import threading
+
+from binproto2 import ConnectionLost, FatalError, Protocol, ReadTimeout
+from serial import SerialException
+from octoprint_marlinbft.baudrate import BaudRateEscalation
+from octoprint_marlinbft.fileproto import AdaptiveBlockSize, BftFileTransfer, FixedBlockSize, RetransmissionTimer
+from octoprint_marlinbft.readiness import ReadinessProbe
+from octoprint_marlinbft.sync import list_remote_files
+from octoprint_marlinbft.timeline import Profiler, Timeline
+from octoprint_marlinbft.utils import BftLogger, Compression, DeleteUpload, Setting, Phase, SettingsResolver
+from copy import deepcopy
+from time import sleep, strftime
 try:
     from time import perf_counter
 except ImportError:
     # Python < 3.3
     from backports.time_perf_counter import perf_counter
 
+# parallel jobs on other ports remember their block sizes in the same setting
+_block_size_memory_lock = threading.Lock()
+
 
 class _FileInfo:
 
-    def __init__(self, local_path, local_basename, remote_basename, local_diskpath):
+    def __init__(self, local_path, local_basename, remote_basename, local_diskpath, source=None, size=None, payload=None):
         self.local_path = local_path
         self.local_basename = local_basename
         self.remote_basename = remote_basename
         self.local_diskpath = local_diskpath
+        self.source = source
+        self.size = size
+        self.payload = payload
+
+class ResumeStore(object):
+    """
+    Remembers the last acknowledged offset of interrupted transfers, keyed by port, remote
+    name and the size and modification time of the local file.
+    """
+
+    def __init__(self):
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(port, fileInfo):
+        stat = os.stat(fileInfo.local_diskpath)
+        return "%s|%s|%s|%s" % (port, fileInfo.remote_basename, stat.st_size, stat.st_mtime)
+
+    def get(self, key):
+        with self._lock:
+            return self._offsets.get(key, 0)
+
+    def set(self, key, offset):
+        with self._lock:
+            if offset:
+                self._offsets[key] = offset
+            else:
+                self._offsets.pop(key, None)
 
 class Process:
-    def __init__(self, logger, settings, bft_logger):
+    """
+    A single transfer job. Each job gets its own Process so its settings overrides are
+    isolated from jobs running on other ports.
+    """
+
+    retryable = (ConnectionLost, FatalError, ReadTimeout, SerialException)
+
+    def __init__(self, logger, settings, bft_logger, payload_cache=None, resume_store=None, reconnector=None, history=None,
+                 metrics=None, profile_folder=None):
         self.logger = logger
         self.settings = SettingsResolver(settings, logger)
         self.bft_logger = bft_logger
+        self.payload_cache = payload_cache
+        self.resume_store = resume_store or ResumeStore()
+        self.reconnector = reconnector
+        self.history = history
+        self.metrics = metrics
+        self.profile_folder = profile_folder
+        self.post_transfer_gcode_sent = False
+        self._interrupted = None
+        self._timeline = None
+        self._escalation = None
+        self._printer = None
+        self._baudrate = None
 
     def start(self, handler, local_basename, remote_basename, disk_path, port, baudrate, local_path, **kwargs):
+        fileInfo = _FileInfo(local_path, local_basename, remote_basename, disk_path)
+        self._run(handler, fileInfo, [fileInfo], port, baudrate, kwargs)
+
+    def start_stream(self, handler, source, size, local_basename, remote_basename, port, baudrate, **kwargs):
+        """
+        Copies the chunks of an upload while it arrives. source is a StreamSource and size the
+        expected number of bytes, if known. A stream cannot be replayed, so it is not retried.
+        """
+        fileInfo = _FileInfo(None, local_basename, remote_basename, None, source, size)
+        try:
+            self._run(handler, fileInfo, [fileInfo], port, baudrate, kwargs)
+        finally:
+            # unblock the upload if the transfer ended before reading all of it
+            source.abort("Transfer ended")
+
+    def start_shared(self, handler, payload, local_basename, remote_basename, port, baudrate, local_path, **kwargs):
+        """
+        Copies a SharedPayload, one of the targets of a broadcast. The payload is held in
+        memory, so unlike a stream it can be retried.
+        """
+        fileInfo = _FileInfo(local_path, local_basename, remote_basename, None, size=payload.size, payload=payload)
+        self._run(handler, fileInfo, [fileInfo], port, baudrate, kwargs)
+
+    def start_batch(self, handler, files, port, baudrate, **kwargs):
+        """
+        Copies several files over a single protocol session. files is a list of
+        (local_path, local_basename, remote_basename, disk_path) tuples.
+        """
+        fileInfos = [_FileInfo(*f) for f in files]
+        summary = _FileInfo([f.local_path for f in fileInfos],
+                            "%s files" % len(fileInfos),
+                            ", ".join(f.remote_basename for f in fileInfos),
+                            None)
+        self._run(handler, summary, fileInfos, port, baudrate, kwargs, batch=True)
+
+    def start_sync(self, handler, files, port, baudrate, manifest, **kwargs):
+        """
+        Like start_batch, but only copies the files that the manifest says are new or changed
+        for this printer, and records every copied file in the manifest.
+        """
+        fileInfos = [_FileInfo(*f) for f in files]
+        summary = _FileInfo([f.local_path for f in fileInfos], "%s files" % len(fileInfos), "sync", None)
+        printer = self._printer_key(port, kwargs.get("printer_profile"))
+
+        def select(protocol):
+            remote_files = None
+            if self.settings.get_boolean(Setting.SyncQueryRemote):
+                remote_files = list_remote_files(protocol)
+                if remote_files is None:
+                    self.bft_logger.info("Firmware did not list its files, trusting the manifest")
+            selected = manifest.select(printer, fileInfos, remote_files)
+            self.bft_logger.info("%s of %s files need to be synced: %s" % (
+                len(selected), len(fileInfos), ", ".join(f.remote_basename for f in selected) or "none"))
+            return selected
+
+        self._run(handler, summary, fileInfos, port, baudrate, kwargs, batch=True,
+                  select=select, on_copied=lambda fileInfo: manifest.record(printer, fileInfo))
+
+    def _run(self, handler, summary, fileInfos, port, baudrate, kwargs, batch=False, select=None, on_copied=None):
         protocol = None
-        fileInfo = None
+        filetransfer = None
         start_pc = 0
+        completed = []
+        failed = []
+        timer = None
+        profiler = None
+        timeline = self._timeline = Timeline()
+        self._printer = self._printer_key(port, kwargs.get("printer_profile"))
+        self._baudrate = baudrate
         try:
             self.logger.info(kwargs)
-            self.settings.override_settings = kwargs
+            self.settings.override_settings = deepcopy(kwargs)
             self.logger.info(self.settings.override_settings)
-            fileInfo = _FileInfo(local_path, local_basename, remote_basename, disk_path)
+            profiler = self._profiler()
+            timeline.phase(Phase.Connect)
+            # one timer for every attempt, the round trips of the link outlast a reconnect
+            timer = self._retransmission_timer()
             start_pc = perf_counter()
-            handler.start(local_basename, remote_basename)
+            handler.start(summary.local_basename, summary.remote_basename)
             self.logger.info("Starting transfer process")
-            protocol = Protocol(port, baudrate, 512, self.settings.get_int(Setting.CommTimeout), self.bft_logger.copy(prefix="binproto2"))
+            block_size_key = self._printer
+            retries = self.settings.get_int(Setting.TransferRetries)
+            attempt = 0
+            while True:
+                try:
+                    block_size = self._initial_block_size(block_size_key)
+                    with timeline.step("port_open", attempt=attempt):
+                        protocol = Protocol(port, baudrate, block_size, self.settings.get_int(Setting.CommTimeout), self.bft_logger.copy(prefix="binproto2"))
 
-            wait_after_connect = self.settings.get_int(Setting.WaitAfterConnect)
-            if wait_after_connect > 0:
-                self.bft_logger.info("waiting %sms after protocol connect" % wait_after_connect)
-                sleep(wait_after_connect / 1000)
+                    with timeline.step("wait_after_connect"):
+                        self._wait_after_connect(protocol)
+                    protocol = self._escalate_baudrate(protocol, port, block_size)
+                    # the history shows the rate the files were sent at, not the one OctoPrint connects at
+                    self._baudrate = protocol.baud
 
-            protocol.send_ascii("M155 S0")
-            protocol.send_ascii("M117 Receiving file " + remote_basename + " ...")
-            protocol.connect()
+                    self._send_gcode(protocol, "M155 S0")
+                    self._send_gcode(protocol, "M117 Receiving file " + summary.remote_basename + " ...")
+                    if select:
+                        with timeline.step("select_files"):
+                            fileInfos, select = select(protocol), None
+                    with timeline.step("connect"):
+                        protocol.connect()
 
-            handler.fire_changed(Phase.Transfer)
+                    timeline.phase(Phase.Transfer)
+                    handler.fire_changed(Phase.Transfer)
 
-            filetransfer = FileTransferProtocol(protocol, logger=self.bft_logger.copy(prefix="fileproto"))
-            filetransfer.copy(disk_path, remote_basename, True, False)
+                    block_sizer = self._block_sizer(protocol)
+                    filetransfer = BftFileTransfer(protocol, block_sizer,
+                                                   payload_cache=self.payload_cache if self.settings.get_boolean(Setting.CacheEnable) else None,
+                                                   cache_max_bytes=self.settings.get_int(Setting.CacheSizeMb) * 1024 * 1024,
+                                                   progress=handler.progress,
+                                                   progress_interval=self.settings.get_int(Setting.ProgressInterval) / 1000.0,
+                                                   chunk_size=self.settings.get_int(Setting.ReadBuffer) * 1024,
+                                                   logger=self.bft_logger.copy(prefix="fileproto"),
+                                                   metrics=self.metrics,
+                                                   pipeline_window=self.settings.get_int(Setting.PipelineWindow),
+                                                   timer=timer,
+                                                   timeline=timeline)
+                    self._copy_files(handler, filetransfer, fileInfos, batch, port, completed, failed, on_copied)
+                    break
+                except self.retryable as exc:
+                    if isinstance(exc, FatalError) and self.metrics:
+                        self.metrics.fatal_errors.inc()
+                    if attempt >= retries or any(f.source for f in fileInfos):
+                        raise
+                    attempt += 1
+                    self.bft_logger.warn("Transfer interrupted (%s), retrying (%s of %s)" % (type(exc).__name__, attempt, retries))
+                    with timeline.step("leave_binary"):
+                        self._leave_binary_quietly(protocol, filetransfer)
+                    self._shutdown(self._restore_baudrate_quietly(protocol))
+                    protocol = None
+                    filetransfer = None
 
+            self._remember_block_size(block_size_key, block_sizer)
+
+            timeline.phase(Phase.PostTransfer)
             self.bft_logger.info("Finishing up (this could take some time)...")
-            protocol.send_ascii("M117 ...Done! %s" % remote_basename)
-            protocol.disconnect()
-            self._success(handler, protocol, fileInfo, start_pc)
+            # the firmware only answers ascii commands again once it has left binary mode
+            with timeline.step("disconnect"):
+                protocol.disconnect()
+            with timeline.step("baudrate_restore"):
+                protocol = self._restore_baudrate(protocol)
+            self._send_gcode(protocol, "M117 ...Done! %s" % summary.remote_basename)
+            if failed:
+                self._fail(handler, protocol, "%s of %s files failed" % (len(failed), len(fileInfos)), summary, start_pc)
+            else:
+                self._success(handler, protocol, summary, start_pc)
         except KeyboardInterrupt:
-            filetransfer.abort()
-            self._fail(handler, protocol, "Aborting transfer", fileInfo, start_pc)
+            if filetransfer:
+                filetransfer.abort()
+            self._record_unfinished(handler, self._selected(fileInfos, select), completed, failed, port, "Aborting transfer")
+            self._fail(handler, protocol, "Aborting transfer", summary, start_pc, outcome="aborted")
         except FatalError:
-            self._fail(handler, protocol, "Too many retries", fileInfo, start_pc)
+            self._record_unfinished(handler, self._selected(fileInfos, select), completed, failed, port, "Too many retries")
+            self._fail(handler, protocol, "Too many retries", summary, start_pc)
         except Exception as exc:
-            self._fail(handler, protocol, exc, fileInfo, start_pc)
+            self._record_unfinished(handler, self._selected(fileInfos, select), completed, failed, port, exc)
+            self._fail(handler, protocol, exc, summary, start_pc)
         finally:
+            protocol = self._restore_baudrate_quietly(protocol)
             if (protocol):
-                protocol.shutdown()
+                with timeline.step("shutdown"):
+                    protocol.shutdown()
+            if timer and timer.samples:
+                handler.round_trips(timer.stats())
+            with timeline.step("reconnect"):
+                self._reconnect(handler, port, baudrate, kwargs.get("printer_profile"))
+            self._report_timeline(handler, timeline, profiler, port)
             handler.fire_changed(Phase.Inactive)
 
+    def _wait_after_connect(self, protocol):
+        """
+        Waits up to wait_after_connect_ms for the board, which may reset when the port opens.
+        With the readiness probe enabled the wait ends as soon as the firmware answers.
+        """
+        wait_after_connect = self.settings.get_int(Setting.WaitAfterConnect)
+        if wait_after_connect <= 0:
+            return
+
+        if not self.settings.get_boolean(Setting.ReadinessProbe):
+            self.bft_logger.info("waiting %sms after protocol connect" % wait_after_connect)
+            sleep(wait_after_connect / 1000)
+            return
+
+        self.bft_logger.info("probing firmware readiness for up to %sms" % wait_after_connect)
+        probe = ReadinessProbe(protocol, self.bft_logger.copy(prefix="readiness"),
+                               self.settings.get(Setting.ReadinessProbeGcode),
+                               self.settings.get_int(Setting.ReadinessInterval))
+        ready = probe.wait(wait_after_connect)
+        if ready is None:
+            self.bft_logger.warn("firmware did not answer within %sms, continuing" % wait_after_connect)
+        else:
+            self.bft_logger.info("firmware ready after %sms" % int(ready * 1000))
+
+    def _escalate_baudrate(self, protocol, port, block_size):
+        """
+        Switches to escalate_baudrate for the transfer if it is set. The firmware is switched
+        back before the transfer ends, see _restore_baudrate.
+        """
+        target = self.settings.get_int(Setting.EscalateBaudrate)
+        if not target:
+            return protocol
+
+        def open_protocol(baudrate):
+            return Protocol(port, baudrate, block_size, self.settings.get_int(Setting.CommTimeout), self.bft_logger.copy(prefix="binproto2"))
+
+        self._escalation = BaudRateEscalation(open_protocol, self.bft_logger.copy(prefix="baudrate"),
+                                              self.settings.get(Setting.EscalateBaudrateGcode),
+                                              self.settings.get(Setting.ReadinessProbeGcode),
+                                              self.settings.get_int(Setting.ReadinessInterval))
+        with self._timeline.step("baudrate_escalation", baudrate=target):
+            return self._escalation.escalate(protocol, target)
+
+    def _restore_baudrate(self, protocol):
+        if not self._escalation or not protocol:
+            return protocol
+        return self._escalation.restore(protocol)
+
+    def _restore_baudrate_quietly(self, protocol):
+        # the firmware has to be back at the original rate before OctoPrint reconnects, but a
+        # failure to restore it must not hide the error that ended the transfer, nor leave
+        # the port open
+        try:
+            return self._restore_baudrate(protocol)
+        except Exception as exc:
+            self.logger.exception("Restoring the baud rate failed")
+            self.bft_logger.error("Restoring the baud rate failed: %s" % exc)
+            self._shutdown(protocol)
+            return None
+
+    def _leave_binary_quietly(self, protocol, filetransfer):
+        """
+        Takes the firmware out of binary mode after a failed attempt. Otherwise it ignores the
+        ascii commands the next attempt starts with, and each of them waits 20 times the
+        comm timeout. The link may be gone, so every step waits a tenth of that at most.
+        """
+        if not protocol:
+            return
+        response_timeout = protocol.response_timeout
+        protocol.response_timeout = max(1, response_timeout // 10)
+        try:
+            # the sync ids of host and firmware may disagree after a failure, resynchronize
+            # first, and drop the answers to packets that were sent more than once
+            self._settle(protocol)
+            protocol._send(0, 1)
+            self._settle(protocol)
+            if filetransfer and filetransfer.resumable:
+                # keeps what was written so far, the retry reopens the file at the acknowledged offset
+                filetransfer.close()
+            elif filetransfer:
+                # closes the file the firmware still has open
+                filetransfer.abort()
+            protocol.disconnect()
+        except Exception as exc:
+            self.logger.info("Could not take the firmware out of binary mode: %s" % exc)
+        finally:
+            protocol.response_timeout = response_timeout
+
+    @staticmethod
+    def _settle(protocol):
+        sleep(protocol.response_timeout / 1000.0)
+        protocol.responses.clear()
+
+    def _send_gcode(self, protocol, gcode):
+        with self._timeline.step("gcode", command=gcode.split(" ")[0]):
+            protocol.send_ascii(gcode)
+
+    def _profiler(self):
+        if not self.profile_folder or not self.settings.get_boolean(Setting.ProfileTransfers):
+            return None
+        profiler = Profiler(self.profile_folder, self.bft_logger.copy(prefix="profile"))
+        profiler.start()
+        return profiler
+
+    def _report_timeline(self, handler, timeline, profiler, port):
+        result = timeline.to_dict()
+        if profiler:
+            job = getattr(handler, "job", None)
+            name = "%s-%s" % (strftime("%Y%m%d-%H%M%S"), job.id if job else os.path.basename(port))
+            result["profile"] = profiler.stop(name)
+        handler.timeline(result)
+
+    def _reconnect(self, handler, port, baudrate, printer_profile):
+        if not self.reconnector or not self.settings.get_boolean(Setting.Reconnect):
+            return
+        try:
+            timings = self.reconnector.reconnect(port, baudrate, printer_profile, self.settings, self.bft_logger,
+                                                 expect_reset=self.post_transfer_gcode_sent)
+        except Exception as exc:
+            self.logger.exception("Reconnecting the printer failed")
+            self.bft_logger.error("Reconnecting the printer failed: %s" % exc)
+            return
+        if timings:
+            handler.reconnected(port, timings)
+
+    def _shutdown(self, protocol):
+        if not protocol:
+            return
+        try:
+            protocol.shutdown()
+        except Exception as exc:
+            self.logger.warn("Error closing protocol: %s" % exc)
+
+    def _copy_files(self, handler, filetransfer, fileInfos, batch, port, completed, failed, on_copied=None):
+        """
+        Copies each file not yet in completed or failed, appending it to one of them. Outside of
+        a batch any error ends the transfer; in a batch only a link failure does, other errors
+        are reported for that file and the batch moves on. The acknowledged offset of an
+        interrupted file is kept so a retry can resume it.
+        """
+        compression = self._compression()
+        for fileInfo in fileInfos:
+            if fileInfo in completed or fileInfo in failed:
+                continue
+            file_pc = perf_counter()
+            resume_key = ResumeStore.key(port, fileInfo) if fileInfo.local_diskpath else None
+            self._interrupted = None
+            try:
+                with self._timeline.step("copy", file=fileInfo.remote_basename):
+                    if fileInfo.source:
+                        filetransfer.copy_stream(fileInfo.source, fileInfo.remote_basename, compression, False, total=fileInfo.size,
+                                                 cache=self.settings.get_boolean(Setting.StreamCache))
+                    elif fileInfo.payload:
+                        filetransfer.copy_shared(fileInfo.payload, fileInfo.remote_basename, compression, False)
+                    else:
+                        filetransfer.copy(fileInfo.local_diskpath, fileInfo.remote_basename, compression, False,
+                                          resume_offset=self.resume_store.get(resume_key))
+                        self.resume_store.set(resume_key, 0)
+            except Exception as exc:
+                if filetransfer.resumable and resume_key:
+                    self.resume_store.set(resume_key, filetransfer.acknowledged)
+                if not batch or isinstance(exc, self.retryable):
+                    # recorded once the job gives up, a retry may still copy it
+                    self._interrupted = (fileInfo, dict(filetransfer.stats, elapsed=perf_counter() - file_pc))
+                    raise
+                self.bft_logger.error("Transfer of %s failed: %s" % (fileInfo.local_basename, exc))
+                handler.file_complete(fileInfo.local_basename, fileInfo.remote_basename, perf_counter() - file_pc, str(exc))
+                failed.append(fileInfo)
+                self._record(handler, fileInfo, port, filetransfer.stats, perf_counter() - file_pc, exc)
+            else:
+                completed.append(fileInfo)
+                self._record(handler, fileInfo, port, filetransfer.stats, perf_counter() - file_pc)
+                if on_copied:
+                    on_copied(fileInfo)
+                if batch:
+                    handler.file_complete(fileInfo.local_basename, fileInfo.remote_basename, perf_counter() - file_pc)
+
+    def _record(self, handler, fileInfo, port, stats, elapsed, error=None):
+        """
+        Adds a file to the transfer history. elapsed covers the whole copy of the file,
+        including opening and closing it on the remote.
+        """
+        if not self.history:
+            return
+        job = getattr(handler, "job", None)
+        self.history.record(
+            job_id      = job.id if job else None,
+            printer     = self._printer,
+            port        = port,
+            baudrate    = self._baudrate,
+            file        = fileInfo.local_path or fileInfo.local_basename,
+            remote_name = fileInfo.remote_basename,
+            size        = stats.get("size") if stats.get("size") is not None else fileInfo.size,
+            hash        = stats.get("hash"),
+            block_size  = stats.get("block_size"),
+            compression = stats.get("compression"),
+            elapsed     = elapsed,
+            retries     = stats.get("retries", 0),
+            ok          = error is None,
+            error       = str(error) if error is not None else None,
+        )
+
+    def _record_unfinished(self, handler, fileInfos, completed, failed, port, error):
+        if not self.history:
+            return
+        interrupted, stats = self._interrupted or (None, None)
+        for fileInfo in fileInfos:
+            if fileInfo in completed or fileInfo in failed:
+                continue
+            if fileInfo is interrupted:
+                self._record(handler, fileInfo, port, stats, stats["elapsed"], error)
+            else:
+                self._record(handler, fileInfo, port, dict(), 0, error)
+
+    @staticmethod
+    def _selected(fileInfos, select):
+        # a sync that failed before selecting its files has not attempted any of them
+        return fileInfos if not select else []
+
+    def _compression(self):
+        """
+        True, False or Compression.Auto. The setting may be overridden with a bool as well.
+        """
+        mode = self.settings.get(Setting.Compression)
+        if mode is True or str(mode).lower() == Compression.On:
+            return True
+        if mode is False or str(mode).lower() == Compression.Off:
+            return False
+        return Compression.Auto
+
+    def _printer_key(self, port, printer_profile):
+        return "%s@%s" % (printer_profile, port) if printer_profile else port
+
+    def _initial_block_size(self, key):
+        if self.settings.get_boolean(Setting.BlockSizeAdaptive):
+            remembered = (self.settings.get(Setting.BlockSizeMemory) or {}).get(key)
+            if remembered:
+                self.bft_logger.info("Starting with remembered block size %s for %s" % (remembered, key))
+                return int(remembered)
+        return self.settings.get_int(Setting.BlockSize)
+
+    def _block_sizer(self, protocol):
+        if not self.settings.get_boolean(Setting.BlockSizeAdaptive):
+            return FixedBlockSize(protocol.block_size)
+        return AdaptiveBlockSize(protocol.block_size, self.settings.get_int(Setting.BlockSizeMin), protocol.max_block_size)
+
+    def _retransmission_timer(self):
+        adaptive = self.settings.get_boolean(Setting.CommTimeoutAdaptive)
+        timer = RetransmissionTimer(self.settings.get_int(Setting.CommTimeout), self.settings.get_int(Setting.CommTimeoutMin),
+                                    self.settings.get_int(Setting.CommTimeoutMax), adaptive)
+        if adaptive:
+            self.bft_logger.info("Adapting the communication timeout to the round trip time, between %d and %d ms"
+                                 % (timer.floor, timer.ceiling))
+        return timer
+
+    def _remember_block_size(self, key, block_sizer):
+        if not isinstance(block_sizer, AdaptiveBlockSize):
+            return
+        with _block_size_memory_lock:
+            memory = dict(self.settings.base_settings.get(Setting.BlockSizeMemory) or {})
+            memory[key] = block_sizer.size
+            self.settings.base_settings.set(Setting.BlockSizeMemory, memory)
+            self.settings.base_settings.save()
+        self.bft_logger.info("Remembering block size %s for %s" % (block_sizer.size, key))
+
     def _success(self, handler, protocol, fileInfo, start_pc):
         self.logger.info("Transfer succeeded")
         handler.success(fileInfo.local_basename, fileInfo.remote_basename, perf_counter() - start_pc)
+        if self.metrics:
+            self.metrics.transfer("succeeded", perf_counter() - start_pc)
         if self.settings.get_boolean(Setting.PostTransferGcodeEnable):
             self.bft_logger.info("Sending gcode after transfer: %s" % self.settings.get(Setting.PostTransferGcode))
-            protocol.connected = False
-            protocol.worker_thread.join()
-            protocol.send_ascii_no_wait("\n".join(self.settings.get(Setting.PostTransferGcode)))
+            with self._timeline.step("post_transfer_gcode"):
+                protocol.connected = False
+                protocol.worker_thread.join()
+                protocol.send_ascii_no_wait("\n".join(self.settings.get(Setting.PostTransferGcode)))
+            self.post_transfer_gcode_sent = True
         self.bft_logger.info("Done!")
         handler.fire_changed(Phase.CompleteOK, fileInfo.local_path)
 
-    def _fail(self, handler, protocol, error, fileInfo, start_pc):
-        protocol.send_ascii("M117 {0}".format(error))
+    def _fail(self, handler, protocol, error, fileInfo, start_pc, outcome="failed"):
+        if protocol:
+            protocol.send_ascii("M117 {0}".format(error))
         self.logger.error("Transfer failed: {0}".format(error))
         handler.failure(fileInfo.local_basename, fileInfo.remote_basename, perf_counter() - start_pc, str(error))
+        if self.metrics:
+            self.metrics.transfer(outcome, perf_counter() - start_pc if start_pc else 0)
         handler.fire_changed(Phase.CompleteFail, fileInfo.local_path)
\ No newline at end of file
@@ -12,23 +12,56 @@ class _Names:
     _transfer_complete = "transfer_complete"
     _transfer_error    = "transfer_error"
     _phase_changed     = "phase_changed"
+    _transfer_progress = "transfer_progress"
 
 class BftEvents:
     TransferStarted  = staticmethod(lambda: getattr(OEvents, _resolve_event_name(_Names._transfer_started)))
     TransferComplete = staticmethod(lambda: getattr(OEvents, _resolve_event_name(_Names._transfer_complete)))
     TransferError    = staticmethod(lambda: getattr(OEvents, _resolve_event_name(_Names._transfer_error)))
     PhaseChanged     = staticmethod(lambda: getattr(OEvents, _resolve_event_name(_Names._phase_changed)))
+    TransferProgress = staticmethod(lambda: getattr(OEvents, _resolve_event_name(_Names._transfer_progress)))
 
-    Registration = [_Names._transfer_started, _Names._transfer_complete, _Names._transfer_error, _Names._phase_changed]
+    Registration = [_Names._transfer_started, _Names._transfer_complete, _Names._transfer_error, _Names._phase_changed,
+                    _Names._transfer_progress]
 
 class Setting:
     AcceptExtensions        = ["accept_extensions"]
+    BlockSize               = ["block_size"]
+    BlockSizeAdaptive       = ["block_size_adaptive"]
+    BlockSizeMemory         = ["block_size_memory"]
+    BlockSizeMin            = ["block_size_min"]
+    CacheEnable             = ["cache_enable"]
+    CacheSizeMb             = ["cache_size_mb"]
     CommTimeout             = ["comm_timeout_ms"]
+    CommTimeoutAdaptive     = ["comm_timeout_adaptive"]
+    CommTimeoutMax          = ["comm_timeout_max_ms"]
+    CommTimeoutMin          = ["comm_timeout_min_ms"]
+    Compression             = ["compression"]
     HasCapability           = ["has_capability"]
     DeleteUpload            = ["delete_upload"]
+    EscalateBaudrate        = ["escalate_baudrate"]
+    EscalateBaudrateGcode   = ["escalate_baudrate_gcode"]
+    HistoryRetentionDays    = ["history_retention_days"]
+    JobHistorySize          = ["job_history_size"]
+    MaxWorkers              = ["max_workers"]
+    MessageWindow           = ["message_window_ms"]
     Phase                   = ["phase"]
+    PipelineWindow          = ["pipeline_window"]
     PostTransferGcode       = ["post_transfer_gcode"]
     PostTransferGcodeEnable = ["post_transfer_gcode_enable"]
+    ProfileTransfers        = ["profile_transfers"]
+    ProgressInterval        = ["progress_interval_ms"]
+    QueueBusyPort           = ["queue_busy_port"]
+    ReadBuffer              = ["read_buffer_kb"]
+    ReadinessProbe          = ["readiness_probe"]
+    ReadinessProbeGcode     = ["readiness_probe_gcode"]
+    ReadinessInterval       = ["readiness_interval_ms"]
+    StreamBuffer            = ["stream_buffer_kb"]
+    StreamCache             = ["stream_cache"]
+    StreamUpload            = ["stream_upload"]
+    SyncQueryRemote         = ["sync_query_remote"]
+    TerminalMaxLines        = ["terminal_max_lines"]
+    TransferRetries         = ["transfer_retries"]
     Reconnect               = ["reconnect"]
     UploadFolder            = ["upload_folder"]
     WaitAfterConnect        = ["wait_after_connect_ms"]
@@ -36,11 +69,10 @@ class Setting:
 
 class SettingsResolver(object):
 
-    override_settings = {}
-
-    def __init__(self, base_settings, logger):
+    def __init__(self, base_settings, logger, override_settings=None):
         self.base_settings = base_settings
         self.logger = logger
+        self.override_settings = override_settings or {}
 
     def get(self, path):
         def _get(overrides, segments):
@@ -70,6 +102,11 @@ class SettingsResolver(object):
     def get_boolean(self, path):
         return bool(self.get(path))
 
+class Compression:
+    Auto = "auto"
+    On   = "on"
+    Off  = "off"
+
 class DeleteUpload:
     Never         = "Never"
     OnlyOnSuccess = "OnlyOnSuccess"
@@ -100,12 +137,38 @@ class BftHandler(object):
     def failure(self, local_name, remote_name, elapsed, msg):
         pass
 
+    def file_complete(self, local_name, remote_name, elapsed, msg=None):
+        pass
+
+    def progress(self, remote_name, sent, total, throughput, retries, eta):
+        pass
+
+    def reconnected(self, port, timings):
+        pass
+
+    def round_trips(self, stats):
+        pass
+
+    def timeline(self, timeline):
+        pass
+
     def fire_changed(self, current, msg=None):
         pass
 
+def _progress_payload(remote_name, sent, total, throughput, retries, eta):
+    return dict(
+        file       = remote_name,
+        sent       = sent,
+        total      = total,
+        throughput = throughput,
+        retries    = retries,
+        eta        = eta
+    )
+
 class ApiHandler(BftHandler):
     def __init__(self):
         self.output = []
+        self.last_progress = None
 
     def start(self, local_name, remote_name):
         self.output.append("Starting transfer of %s as remote %s" % (local_name, remote_name))
@@ -116,6 +179,27 @@ class ApiHandler(BftHandler):
     def failure(self, local_name, remote_name, elapsed, msg):
         self.output.append("Transfer of %s to remote as %s failed in %s with error %s" % (local_name, remote_name, elapsed, str(msg)))
 
+    def file_complete(self, local_name, remote_name, elapsed, msg=None):
+        if msg:
+            self.output.append("File %s to remote as %s failed in %s with error %s" % (local_name, remote_name, elapsed, str(msg)))
+        else:
+            self.output.append("File %s to remote as %s completed in %s" % (local_name, remote_name, elapsed))
+
+    def progress(self, remote_name, sent, total, throughput, retries, eta):
+        self.last_progress = _progress_payload(remote_name, sent, total, throughput, retries, eta)
+
+    def reconnected(self, port, timings):
+        self.output.append("Reconnected printer on %s in %s" % (port, timings["total"]))
+
+    def round_trips(self, stats):
+        self.output.append("Round trips of %s blocks: min %s ms, mean %s ms, max %s ms, final timeout %s ms" % (
+            stats["samples"], stats["min_ms"], stats["mean_ms"], stats["max_ms"], stats["timeout_ms"]))
+
+    def timeline(self, timeline):
+        self.output.append("Timeline: %s" % ", ".join("%s %.3f s" % (phase["name"], phase["elapsed"]) for phase in timeline["phases"]))
+        if timeline.get("profile"):
+            self.output.append("Profile saved to %s" % timeline["profile"])
+
     def fire_changed(self, current, msg=None):
         self.output.append("Starting phase %s (%s)" % (current, str(msg)))
 
@@ -144,6 +228,27 @@ class DialogHandler(ApiHandler):
         self.fire_changed(Phase.PostTransfer)
         super(ApiHandler,self).failure(local_name, remote_name, elapsed, msg)
 
+    def file_complete(self, local_name, remote_name, elapsed, msg=None):
+        self.logger.info("DIALOG_FILE_COMPLETE %s %s %s %s" % (local_name, remote_name, elapsed, msg))
+        super(ApiHandler,self).file_complete(local_name, remote_name, elapsed, msg)
+
+    def progress(self, remote_name, sent, total, throughput, retries, eta):
+        self.last_progress = _progress_payload(remote_name, sent, total, throughput, retries, eta)
+        self.event_bus.fire(BftEvents.TransferProgress(), self.last_progress)
+        super(ApiHandler,self).progress(remote_name, sent, total, throughput, retries, eta)
+
+    def reconnected(self, port, timings):
+        self.logger.info("DIALOG_RECONNECTED %s %s" % (port, timings))
+        super(ApiHandler,self).reconnected(port, timings)
+
+    def round_trips(self, stats):
+        self.logger.info("DIALOG_ROUND_TRIPS %s" % stats)
+        super(ApiHandler,self).round_trips(stats)
+
+    def timeline(self, timeline):
+        self.logger.info("DIALOG_TIMELINE %s" % timeline)
+        super(ApiHandler,self).timeline(timeline)
+
     def fire_changed(self, current, msg=None):
         self.event_bus.fire(BftEvents.PhaseChanged(), dict(
             prev = self.settings.get(Setting.Phase),
@@ -153,12 +258,126 @@ class DialogHandler(ApiHandler):
         super(ApiHandler,self).fire_changed(current, msg)
 
 import copy
+import io
+import os
+import threading
+import time
+from collections import deque
+
+class MessageLog(object):
+    """
+    Every plugin message with the time it was sent, in a file the dialog terminal downloads
+    in full, as it only keeps the most recent lines. Lines are written buffered and flushed
+    by the message channel once per window. When the file grows past max_bytes it is started
+    over and the previous one is kept as path.1.
+    """
+
+    def __init__(self, path, logger, max_bytes=5 * 1024 * 1024):
+        self.path = path
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, msg, when=None):
+        line = "%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), msg)
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = io.open(self.path, "a", encoding="utf-8")
+                self._file.write(line)
+                if self._file.tell() > self.max_bytes:
+                    self._rotate()
+            except (IOError, OSError) as exc:
+                self.logger.warn("Could not write message log %s: %s" % (self.path, exc))
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def read(self):
+        self.flush()
+        text = ""
+        for path in (self.path + ".1", self.path):
+            if os.path.exists(path):
+                with io.open(path, encoding="utf-8", errors="replace") as f:
+                    text += f.read()
+        return text
+
+    def _rotate(self):
+        # the caller holds the lock
+        self._file.close()
+        self._file = None
+        if os.path.exists(self.path + ".1"):
+            os.remove(self.path + ".1")
+        os.rename(self.path, self.path + ".1")
+
+class MessageChannel(object):
+    """
+    Coalesces plugin messages and sends them as a single list payload once per window, or
+    sooner when max_lines are waiting. push never blocks on the socket; if more than
+    max_pending lines are waiting, new lines are dropped and a summary line is sent instead.
+    Lines that are dropped are still written to the log, if there is one, by the channel
+    thread so the file is never written from the thread that pushes.
+    """
+
+    def __init__(self, plugin_manager, window_ms=250, max_lines=50, max_pending=500, log=None):
+        self.plugin_manager = plugin_manager
+        self.window = window_ms / 1000.0
+        self.max_lines = max_lines
+        self.max_pending = max_pending
+        self.log = log
+        self._pending = deque()
+        self._logged = []
+        self._dropped = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def push(self, msg):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            if self.log:
+                self._logged.append((time.time(), msg))
+                if not self._pending:
+                    self._cond.notify()
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                return
+            self._pending.append(msg)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_lines:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._logged:
+                    self._cond.wait()
+                if len(self._pending) < self.max_lines:
+                    self._cond.wait(self.window)
+                lines = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_lines))]
+                logged, self._logged = self._logged, []
+                dropped, self._dropped = self._dropped, 0
+
+            for when, msg in logged:
+                self.log.append(msg, when)
+            if dropped:
+                lines.append("... %s messages dropped" % dropped)
+            if lines:
+                self.plugin_manager.send_plugin_message("marlinbft", lines)
+            if logged:
+                self.log.flush()
 
 class BftLogger:
-    def __init__(self, logger, plugin_manager, prefix = None):
+    def __init__(self, logger, plugin_manager, prefix = None, channel = None, metrics = None):
         self.logger = logger
         self.plugin_manager = plugin_manager
         self.prefix = prefix or "BFT"
+        self.channel = channel or MessageChannel(plugin_manager)
+        self.metrics = metrics
 
     def info(self, msg):
         self.logger.info(self._prefix(msg))
@@ -166,11 +385,15 @@ class BftLogger:
 
     def debug(self, msg):
         self.logger.debug(self._prefix(msg))
+        if self.metrics:
+            self.metrics.log(self.prefix, msg)
 
     def warn(self, msg):
         self.logger.warn(self._prefix(msg))
         self._push(msg)
 
+    warning = warn
+
     def error(self, msg):
         self.logger.error(self._prefix(msg))
         self._push(msg)
@@ -181,7 +404,7 @@ class BftLogger:
         return c
 
     def _push(self, msg):
-        self.plugin_manager.send_plugin_message("marlinbft", str(msg))
+        self.channel.push(str(msg))
 
     def _prefix(self, msg):
         return "[%s]: %s" % (self.prefix, str(msg))
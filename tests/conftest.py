@@ -0,0 +1,63 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+
+from octoprint_marlinbft import MarlinbftPlugin
+from octoprint_marlinbft.transfer import Process
+from octoprint_marlinbft.utils import ApiHandler, BftLogger
+from benchmark import _PluginManager, _Settings, _payload
+from virtual_marlin import VirtualMarlin
+
+
+class Transfer(object):
+    """
+    Runs Process.start against a VirtualMarlin. The device and the settings are built from
+    the keyword arguments, settings override the plugin's defaults.
+    """
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.logger = logging.getLogger("tests")
+        self.devices = []
+
+    def source(self, size, content="random", seed=1, name="part.gco"):
+        data = _payload(size, content, seed)
+        path = os.path.join(str(self.tmpdir), name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path, data
+
+    def device(self, **kwargs):
+        device = VirtualMarlin(**kwargs)
+        device.port = device.start()
+        self.devices.append(device)
+        return device
+
+    def run(self, device, path, remote="PART.GCO", payload_cache=None, resume_store=None, **settings):
+        values = MarlinbftPlugin().get_settings_defaults()
+        values.update(reconnect=False, wait_after_connect_ms=0, post_transfer_gcode_enable=False)
+        values.update(settings)
+        handler = ApiHandler()
+        process = Process(self.logger, _Settings(values), BftLogger(self.logger, _PluginManager()),
+                          payload_cache=payload_cache, resume_store=resume_store)
+        process.start(handler, os.path.basename(path), remote, path, device.port, 250000, os.path.basename(path))
+        return handler
+
+    def stop(self):
+        for device in self.devices:
+            device.stop()
+
+
+@pytest.fixture
+def transfer(tmpdir):
+    transfer = Transfer(tmpdir)
+    yield transfer
+    transfer.stop()
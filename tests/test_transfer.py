@@ -0,0 +1,62 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+
+import logging
+
+from octoprint_marlinbft.cache import PayloadCache
+from octoprint_marlinbft.transfer import ResumeStore
+
+
+def _succeeded(handler):
+    return any("CompleteOK" in line for line in handler.output)
+
+
+def test_adaptive_timeout_survives_sd_write_stalls(transfer):
+    # the timeout adapts to the fast acknowledgements, so a block the device stalls on is
+    # sent again and acknowledged twice; the second ok must not break the transfer
+    path, data = transfer.source(64 * 1024)
+    device = transfer.device(latency_ms=1, stall_every=40, stall_ms=300)
+
+    handler = transfer.run(device, path, compression="off", comm_timeout_adaptive=True, transfer_retries=0)
+
+    assert _succeeded(handler), handler.output
+    assert device.files["PART.GCO"] == data
+    assert device.stalls == 3
+
+
+def test_go_back_n_recovers_lost_blocks(transfer):
+    path, data = transfer.source(64 * 1024)
+    device = transfer.device(latency_ms=1, receive_window=8, drop_rate=0.02, seed=3)
+
+    handler = transfer.run(device, path, compression="off", pipeline_window=8, transfer_retries=0)
+
+    assert _succeeded(handler), handler.output
+    assert device.files["PART.GCO"] == data
+    assert device.dropped > 0
+
+
+def test_resumes_after_the_link_drops(transfer, caplog):
+    path, data = transfer.source(100 * 1024)
+    device = transfer.device(latency_ms=2, receive_window=4, resume=True, fatal_after=80, seed=2)
+
+    with caplog.at_level(logging.INFO):
+        handler = transfer.run(device, path, compression="off", pipeline_window=8, transfer_retries=2,
+                               resume_store=ResumeStore())
+
+    assert _succeeded(handler), handler.output
+    assert device.files["PART.GCO"] == data
+    assert "Resuming transfer at offset" in caplog.text
+
+
+def test_second_transfer_is_sent_from_the_cache(transfer, tmpdir):
+    path, data = transfer.source(64 * 1024, content="gcode")
+    cache = PayloadCache(str(tmpdir.mkdir("cache")), logging.getLogger("tests"))
+
+    for remote in ("FIRST.GCO", "SECOND.GCO"):
+        device = transfer.device(latency_ms=1)
+        handler = transfer.run(device, path, remote=remote, payload_cache=cache, compression="on")
+        assert _succeeded(handler), handler.output
+        assert device.files[remote] == data
+
+    assert cache.misses == 1
+    assert cache.hits == 1
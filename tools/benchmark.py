@@ -0,0 +1,150 @@
+# coding=utf-8
+"""
+Transfer throughput benchmark
+
+Runs transfer.Process.start against a VirtualMarlin device for every combination of file
+size, block size, compression mode (on, off or auto) and pipeline window (0 for
+stop-and-wait), and prints elapsed time, throughput and retries.
+
+    python tools/benchmark.py --sizes 64,256 --block-sizes 128,256,512 --baudrate 250000 --latency-ms 1
+    python tools/benchmark.py --sizes 256 --block-sizes 512 --windows 0,4,16 --latency-ms 4
+
+Requires OctoPrint and marlin-binary-protocol to be importable, as the plugin does.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from octoprint_marlinbft import MarlinbftPlugin
+from octoprint_marlinbft.transfer import Process
+from octoprint_marlinbft.utils import ApiHandler, BftLogger
+from virtual_marlin import VirtualMarlin
+
+
+class _Settings(object):
+    """
+    The subset of OctoPrint's plugin settings that Process uses, backed by a dict.
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path):
+        return self.values[path[0]]
+
+    def set(self, path, value):
+        self.values[path[0]] = value
+
+    def save(self):
+        pass
+
+
+class _PluginManager(object):
+    def send_plugin_message(self, identifier, message):
+        pass
+
+
+def _payload(size, content, seed):
+    rnd = random.Random(seed)
+    if content == "random":
+        return bytes(bytearray(rnd.getrandbits(8) for _ in range(size)))
+
+    lines = []
+    length = 0
+    while length < size:
+        line = "G1 X%.3f Y%.3f E%.5f F%d\n" % (rnd.uniform(0, 220), rnd.uniform(0, 220), rnd.uniform(0, 2), rnd.choice([1800, 3000, 6000]))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode("ascii")[:size]
+
+
+def run(size_kib, block_size, mode, window, args, logger):
+    data = _payload(size_kib * 1024, args.content, args.seed)
+    with tempfile.NamedTemporaryFile(suffix=".gco", delete=False) as f:
+        f.write(data)
+
+    device = VirtualMarlin(latency_ms=args.latency_ms, baudrate=args.baudrate, corrupt_rate=args.corrupt_rate,
+                           drop_rate=args.drop_rate, max_block_size=block_size, compression=mode != "off",
+                           seed=args.seed, receive_window=window)
+    port = device.start()
+
+    settings = MarlinbftPlugin().get_settings_defaults()
+    settings.update(comm_timeout_ms=args.comm_timeout_ms, cache_enable=False)
+
+    handler = ApiHandler()
+    bft_logger = BftLogger(logger, _PluginManager())
+    try:
+        Process(logger, _Settings(settings), bft_logger).start(
+            handler, "bench.gco", "BENCH.GCO", f.name, port, args.baudrate or 250000, "bench.gco",
+            block_size=block_size, compression=mode, pipeline_window=window)
+    finally:
+        device.stop()
+        os.remove(f.name)
+
+    elapsed = _elapsed(handler)
+    ok = device.files.get("BENCH.GCO") == data
+    progress = handler.last_progress or {}
+    return dict(
+        size=size_kib,
+        block=block_size,
+        compression=mode,
+        window=window,
+        elapsed=elapsed,
+        kibs=size_kib / elapsed if elapsed else 0,
+        retries=progress.get("retries", 0),
+        ok="ok" if ok else "FAIL",
+    )
+
+
+def _elapsed(handler):
+    for line in handler.output:
+        if " completed in " in line:
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Marlin BFT transfers against a virtual device")
+    parser.add_argument("--sizes", default="16,64,256", help="comma-delimited file sizes in KiB")
+    parser.add_argument("--block-sizes", default="128,256,512", help="comma-delimited block sizes in bytes")
+    parser.add_argument("--compression", default="on,off", help="comma-delimited list of on/off/auto")
+    parser.add_argument("--windows", default="0", help="comma-delimited pipeline windows, 0 for stop-and-wait")
+    parser.add_argument("--content", choices=["gcode", "random"], default="gcode")
+    parser.add_argument("--baudrate", type=int, default=None, help="emulated baud rate, unlimited if not given")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--comm-timeout-ms", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    logger = logging.getLogger("benchmark")
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    block_sizes = [int(b) for b in args.block_sizes.split(",")]
+    compressions = [c.strip() for c in args.compression.split(",")]
+    windows = [int(w) for w in args.windows.split(",")]
+
+    row = "{size:>8} {block:>6} {compression:>5} {window:>6} {elapsed:>9} {kibs:>9} {retries:>7} {ok:>4}"
+    print(row.format(size="KiB", block="block", compression="comp", window="window", elapsed="seconds", kibs="KiB/s",
+                     retries="retries", ok=""))
+    for size, block_size, compression, window in itertools.product(sizes, block_sizes, compressions, windows):
+        result = run(size, block_size, compression, window, args, logger)
+        result.update(elapsed="%.3f" % result["elapsed"], kibs="%.2f" % result["kibs"])
+        print(row.format(**result))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
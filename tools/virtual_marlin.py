@@ -0,0 +1,429 @@
+# coding=utf-8
+"""
+Virtual Marlin BFT device
+
+A pty-backed stand-in for a Marlin printer with BINARY_FILE_TRANSFER enabled. It answers
+the ASCII commands the plugin sends before switching to binary mode and implements the
+receiving side of the binary protocol and the file transfer protocol. Latency, baud rate,
+packet corruption, packet drops and the boot time of a board that resets when the port is
+opened can be emulated. With receive_window the device advertises that it buffers that
+many write packets, and acknowledges them go-back-N: packets after a lost one are dropped
+and a single resend is requested for it. With stall_every the device stops for stall_ms
+before it acknowledges every stall_every-th write packet, like a board that flushes its SD
+card buffer. With serial_baudrate the device only understands
+a host whose port is set to the same rate, and switches it with M575 like Marlin with
+BAUD_RATE_GCODE.
+
+    device = VirtualMarlin(latency_ms=2, baudrate=115200, corrupt_rate=0.01)
+    port = device.start()
+    ...  # open port with Protocol(port, ...)
+    device.stop()
+    device.files  # {remote name: received bytes}
+
+Run it on its own to expose a device for manual testing:
+
+    python tools/virtual_marlin.py --baudrate 115200 --latency-ms 2
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import fcntl
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+from array import array
+from collections import deque
+
+try:
+    import heatshrink2 as heatshrink
+except ImportError:
+    import heatshrink
+
+PACKET_TOKEN = b"\xad\xb5"
+HEADER_SIZE = 8
+# linux ioctl that reads the termios of a port with custom baud rates as well
+TCGETS2 = 0x802C542A
+
+
+def _checksum(buffer):
+    cs = 0
+    for b in bytearray(buffer):
+        cs_low = ((cs & 0xFF) + b) % 255
+        cs = ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
+    return cs
+
+
+class VirtualMarlin(object):
+    version = "0.2.0"
+    ft_version = "0.1.0"
+
+    def __init__(self, latency_ms=0, baudrate=None, corrupt_rate=0.0, drop_rate=0.0,
+                 max_block_size=512, compression=True, window=8, lookahead=4,
+                 packet_timeout_ms=100, resume=False, fatal_after=None, seed=None, files=None,
+                 boot_ms=0, receive_window=0, serial_baudrate=None, supported_baudrates=None, stall_every=0,
+                 stall_ms=0):
+        self.latency_ms = latency_ms
+        self.baudrate = baudrate
+        self.corrupt_rate = corrupt_rate
+        self.drop_rate = drop_rate
+        self.max_block_size = max_block_size
+        self.compression = compression
+        self.window = window
+        self.lookahead = lookahead
+        self.packet_timeout_ms = packet_timeout_ms
+        self.resume = resume
+        self.fatal_after = fatal_after
+        self.boot_ms = boot_ms
+        self.receive_window = receive_window
+        self.serial_baudrate = serial_baudrate
+        self.supported_baudrates = supported_baudrates
+        self.stall_every = stall_every
+        self.stall_ms = stall_ms
+        self.random = random.Random(seed)
+
+        self.files = dict(files or {})
+        self.packets = 0
+        self.corrupted = 0
+        self.dropped = 0
+        self.resends = 0
+        self.writes = 0
+        self.stalls = 0
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._binary = False
+        self._sync = 0
+        self._resend_requested = False
+        self._open_file = None
+        self._replies = deque()
+        self._replies_cond = threading.Condition()
+        self._writer = None
+
+    ##~~ lifecycle
+
+    def start(self):
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._writer = threading.Thread(target=self._write_replies)
+        self._writer.daemon = True
+        self._writer.start()
+        return os.ttyname(self._slave)
+
+    def stop(self):
+        self._running = False
+        with self._replies_cond:
+            self._replies_cond.notify_all()
+        for thread in (self._thread, self._writer):
+            if thread:
+                thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    ##~~ io
+
+    def _run(self):
+        buffer = bytearray()
+        last_data = time.time()
+        booted = time.time() + self.boot_ms / 1000
+        if self.boot_ms:
+            self._reply("start")
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], 0.01)
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    data = b""
+                if data and time.time() < booted:
+                    # still booting, input is lost
+                    continue
+                if data and not self._baudrate_matches(self.serial_baudrate):
+                    # garbage at the wrong baud rate
+                    continue
+                if data:
+                    self._emulate_wire(len(data))
+                    buffer += data
+                    last_data = time.time()
+
+            while buffer:
+                consumed = self._process(buffer, stalled=(time.time() - last_data) * 1000 > self.packet_timeout_ms)
+                if not consumed:
+                    break
+                del buffer[:consumed]
+
+    def _baudrate_matches(self, baudrate):
+        if not baudrate:
+            return True
+        buf = array("i", [0] * 64)
+        try:
+            fcntl.ioctl(self._master, TCGETS2, buf)
+        except (IOError, OSError):
+            return True
+        return buf[9] == baudrate
+
+    def _emulate_wire(self, size):
+        if self.baudrate:
+            time.sleep(size * 10 / self.baudrate)
+
+    def _reply(self, line):
+        # replies arrive latency_ms later without holding up the packets that follow, like
+        # on a usb-serial adapter that buffers in both directions
+        with self._replies_cond:
+            self._replies.append((time.time() + self.latency_ms / 1000, self.serial_baudrate, (line + "\n").encode("utf8")))
+            self._replies_cond.notify_all()
+
+    def _write_replies(self):
+        while True:
+            with self._replies_cond:
+                while self._running and not self._replies:
+                    self._replies_cond.wait()
+                if not self._running:
+                    return
+                due, baudrate, data = self._replies.popleft()
+            if due > time.time():
+                time.sleep(max(0, due - time.time()))
+            self._emulate_wire(len(data))
+            if not self._baudrate_matches(baudrate):
+                continue
+            try:
+                os.write(self._master, data)
+            except OSError:
+                return
+
+    ##~~ ascii mode
+
+    def _process(self, buffer, stalled):
+        if self._binary:
+            return self._process_packet(buffer, stalled)
+
+        end = buffer.find(b"\n")
+        if end < 0:
+            return 0
+        line = bytes(buffer[:end]).decode("utf8", "replace").strip()
+        if line:
+            self._gcode(line)
+        return end + 1
+
+    def _gcode(self, line):
+        command = line.split(" ")[0].upper()
+        if command == "M28B1" or line.upper().replace(" ", "") == "M28B1":
+            self._binary = True
+            self._reply("ok")
+        elif command == "M20":
+            self._reply("Begin file list")
+            for name, data in sorted(self.files.items()):
+                self._reply("%s %s" % (name, len(data)))
+            self._reply("End file list")
+            self._reply("ok")
+        elif command == "M575":
+            self._set_baudrate(line)
+        elif command == "M115":
+            self._reply("FIRMWARE_NAME:Marlin VirtualMarlin %s" % self.version)
+            self._reply("Cap:BINARY_FILE_TRANSFER:1")
+            self._reply("ok")
+        else:
+            self._reply("ok")
+
+    def _set_baudrate(self, line):
+        baudrate = None
+        for word in line.split()[1:]:
+            if word[:1].upper() == "B" and word[1:].isdigit():
+                baudrate = int(word[1:])
+        if not baudrate or (self.supported_baudrates and baudrate not in self.supported_baudrates):
+            self._reply("?(B)aud rate implausible.")
+            self._reply("ok")
+            return
+        self._reply("echo:baud rate set to %s" % baudrate)
+        # the ok is sent at the new rate, as Marlin does
+        with self._replies_cond:
+            while self._replies:
+                self._replies_cond.wait(0.01)
+        self.serial_baudrate = baudrate
+        if self.baudrate:
+            self.baudrate = baudrate
+        self._reply("ok")
+
+    ##~~ binary mode
+
+    def _process_packet(self, buffer, stalled):
+        start = buffer.find(PACKET_TOKEN)
+        if start < 0:
+            return max(0, len(buffer) - 1)
+        if start > 0:
+            return start
+
+        if len(buffer) < HEADER_SIZE:
+            return self._stall(stalled)
+
+        header = bytes(buffer[2:HEADER_SIZE])
+        sync, kind, length, header_cs = struct.unpack("<BBHH", header)
+        if _checksum(header[:4]) != header_cs:
+            self._resend()
+            return 1
+
+        size = HEADER_SIZE + (length + 2 if length else 0)
+        if len(buffer) < size:
+            return self._stall(stalled)
+
+        packet = bytes(buffer[:size])
+        self.packets += 1
+
+        if self.fatal_after and self.packets == self.fatal_after:
+            self._reply("fe")
+            return size
+
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return size
+
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            self.corrupted += 1
+            self._resend()
+            return size
+
+        payload = packet[HEADER_SIZE:HEADER_SIZE + length]
+        if length and _checksum(header + payload) != struct.unpack("<H", packet[-2:])[0]:
+            self._resend()
+            return size
+
+        self._dispatch(sync, kind >> 4, kind & 0xF, payload)
+        return size
+
+    def _stall(self, stalled):
+        if not stalled:
+            return 0
+        # an incomplete packet that stopped arriving: skip its token and ask for a resend
+        self._resend()
+        return 1
+
+    def _resend(self):
+        self.resends += 1
+        self._reply("rs%s" % self._sync)
+        self._resend_requested = True
+
+    def _dispatch(self, sync, protocol, packet_type, payload):
+        if protocol == 0 and packet_type == 1:
+            self._reply("ss%s,%s,%s" % (self._sync, self.max_block_size, self.version))
+            return
+
+        if sync != self._sync:
+            behind = (self._sync - sync) % 256
+            if behind == 1 or (self.receive_window and behind <= 128):
+                # the ok for this packet was lost, acknowledge it again without processing
+                self._reply("ok%s" % sync)
+            elif not (self.receive_window and self._resend_requested):
+                # with a window, the packets after a lost one only repeat the request for it
+                self._resend()
+            return
+
+        if protocol == 1 and packet_type == 3:
+            self._write_stall()
+        self._reply("ok%s" % sync)
+        self._sync = (self._sync + 1) % 256
+        self._resend_requested = False
+
+        if protocol == 0 and packet_type == 2:
+            self._binary = False
+        elif protocol == 1:
+            self._file_transfer(packet_type, payload)
+
+    def _write_stall(self):
+        self.writes += 1
+        if self.stall_every and self.writes % self.stall_every == 0:
+            # nothing is read meanwhile, packets sent again arrive once the stall is over
+            self.stalls += 1
+            time.sleep(self.stall_ms / 1000)
+
+    ##~~ file transfer protocol
+
+    def _file_transfer(self, packet_type, payload):
+        if packet_type == 0:
+            compression = "heatshrink,%s,%s" % (self.window, self.lookahead) if self.compression else "none"
+            extensions = ":resume" if self.resume else ""
+            extensions += ":window,%s" % self.receive_window if self.receive_window else ""
+            self._reply("PFT:version:%s:compression:%s%s" % (self.ft_version, compression, extensions))
+        elif packet_type == 1:
+            if self._open_file is not None:
+                self._reply("PFT:busy")
+                return
+            dummy, compressed = bytearray(payload[:2])
+            name, _, extra = payload[2:].partition(b"\0")
+            name = name.decode("utf8")
+            data = bytearray()
+            if self.resume and len(extra) >= 4:
+                offset = struct.unpack("<I", extra[:4])[0]
+                if offset > len(self.files.get(name, b"")):
+                    self._reply("PFT:fail")
+                    return
+                data = bytearray(self.files[name][:offset])
+            self._open_file = dict(name=name, dummy=bool(dummy), compressed=bool(compressed), data=data)
+            self._reply("PFT:success")
+        elif packet_type == 2:
+            if self._open_file is None:
+                self._reply("PTF:invalid")
+                return
+            self._close_file()
+            self._reply("PFT:success")
+        elif packet_type == 3:
+            if self._open_file is not None:
+                self._open_file["data"] += payload
+        elif packet_type == 4:
+            self._open_file = None
+            self._reply("PFT:success")
+
+    def _close_file(self):
+        info, self._open_file = self._open_file, None
+        data = bytes(info["data"])
+        if info["compressed"]:
+            data = heatshrink.decode(data, window_sz2=self.window, lookahead_sz2=self.lookahead)
+        if not info["dummy"]:
+            self.files[info["name"]] = data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expose a virtual Marlin BFT device on a pty")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--baudrate", type=int, default=None)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--max-block-size", type=int, default=512)
+    parser.add_argument("--no-compression", action="store_true")
+    parser.add_argument("--boot-ms", type=int, default=0)
+    parser.add_argument("--receive-window", type=int, default=0)
+    parser.add_argument("--serial-baudrate", type=int, default=None)
+    parser.add_argument("--stall-every", type=int, default=0)
+    parser.add_argument("--stall-ms", type=int, default=0)
+    args = parser.parse_args()
+
+    device = VirtualMarlin(latency_ms=args.latency_ms, baudrate=args.baudrate, corrupt_rate=args.corrupt_rate,
+                           drop_rate=args.drop_rate, max_block_size=args.max_block_size,
+                           compression=not args.no_compression, boot_ms=args.boot_ms,
+                           receive_window=args.receive_window, serial_baudrate=args.serial_baudrate,
+                           stall_every=args.stall_every, stall_ms=args.stall_ms)
+    print("Virtual Marlin listening on %s" % device.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop()
+        for name, data in sorted(device.files.items()):
+            print("%s %s" % (name, len(data)))
+
+
+if __name__ == "__main__":
+    main()